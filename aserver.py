@@ -0,0 +1,166 @@
+import asyncio, msgpack
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Thread
+from typing import Optional, Tuple, Union
+from channels import Session, Server, CHUNK_SIZE, SYNC_NONE
+from chunking import ChunkSizer
+from fetch import FRAME_LENGTH
+from response import Response, RespCode
+from structsock import PeerDisconnect
+
+# commands that start a transfer and so may have to wait for a slot
+ADMITTED = frozenset(('upload', 'parallel_upload', 'batch_upload', 'cas_upload', 'delta_upload'))
+
+class AsyncSession(Session):
+    '''
+    A session driven by an asyncio event loop. Waiting for the next command
+    costs no thread; each command runs the regular Session handlers in the
+    server's executor, where blocking disk and crypto work belongs.
+    '''
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server: 'AsyncServer'):
+        super().__init__(None, server)
+        self._reader = reader
+        self._writer = writer
+        self._loop = asyncio.get_running_loop()
+        self._pending = None
+    async def _read(self) -> bytes:
+        try:
+            head = await self._reader.readexactly(FRAME_LENGTH.size)
+            data = await self._reader.readexactly(FRAME_LENGTH.unpack(head)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            raise PeerDisconnect
+        self._metrics.add('bytes_in', len(data))
+        return data
+    async def _write(self, data: bytes) -> None:
+        try:
+            self._writer.write(FRAME_LENGTH.pack(len(data)))
+            self._writer.write(data)
+            await self._writer.drain()
+        except ConnectionError:
+            raise PeerDisconnect
+        self._metrics.add('bytes_out', len(data))
+    async def _writeFile(self, stream, offset: int, end: int, digest: Future, sizer: Optional[ChunkSizer]=None) -> int:
+        digest = asyncio.wrap_future(digest)
+        frames = 0
+        try:
+            while offset < end:
+                length = min(sizer.size() if sizer else CHUNK_SIZE, end - offset)
+                self._writer.write(FRAME_LENGTH.pack(length))
+                await self._writer.drain()
+                await self._loop.sendfile(self._writer.transport, stream, offset, length)
+                offset += length
+                frames += 1
+                if sizer:
+                    sizer.transferred(length)
+        except ConnectionError:
+            raise PeerDisconnect
+        if sizer:
+            await self._write(b'')
+        await self._write(await digest)
+        return frames
+    def _call(self, coroutine) -> bytes:
+        # called from executor threads only
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+    def _recv(self) -> bytes:
+        if self._pending is not None:
+            data, self._pending = self._pending, None
+            return data
+        return self._call(self._read())
+    def _recvBuffer(self) -> Tuple[memoryview, Optional[bytearray]]:
+        # asyncio streams read into buffers of their own
+        return memoryview(self._recv()), None
+    def _send(self, data: Union[bytes, Response]) -> None:
+        self._call(self._write(bytes(data)))
+    def _sendParts(self, *parts) -> None:
+        self._send(b''.join(parts))
+    def _sendFile(self, stream, offset: int, end: int, digest: Future, sizer: Optional[ChunkSizer]=None) -> None:
+        frames = self._call(self._writeFile(stream, offset, end, digest, sizer))
+        self._fileSent(end - offset, frames)
+    async def _execute(self, func, data: Optional[bytes]) -> None:
+        self._pending = data
+        await self._loop.run_in_executor(self._server.executor(), func)
+    async def run(self) -> None:
+        try:
+            await self._execute(self.prepare, await self._read())
+            while True:
+                data = await self._read()
+                data = msgpack.unpackb(data)
+                if data.get('type') in ADMITTED and self._authorized:
+                    # wait for the slot here, not in a worker: queued uploads
+                    # must not starve the admitted ones' ranges of threads
+                    if not await self._server.admit(self._host):
+                        await self._write(bytes(Response(RespCode.RCE_TRANSMITTER_OCCUPIED)))
+                        continue
+                    await self._execute(lambda: self._server.transmissions().granted(self._host, lambda: self._data(data)), None)
+                    continue
+                await self._execute(lambda: self._data(data), None)
+        except PeerDisconnect:
+            print(self._host or 'Unknown host', 'has disconnected.')
+        finally:
+            self._writer.close()
+
+class AsyncServer(Server):
+    'A Server that serves every session from one asyncio event loop.'
+    def __init__(self, port: int, basedir: str='D:\\', max_transfers: int=8, per_host: int=2, queue_timeout: Optional[float]=None, backlog: int=1024, max_sessions: int=4096, workers: int=32, profile: bool=False, dedup: bool=False, sync: str=SYNC_NONE):
+        super().__init__(port, basedir, max_transfers, per_host, queue_timeout, backlog, profile, dedup, sync)
+        self._maxSessions = max_sessions
+        self._sessions = 0
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='Worker')
+        self._loop = self._server = None
+        self._admission = None # set and replaced whenever a slot may have freed up
+    def executor(self) -> ThreadPoolExecutor:
+        return self._executor
+    def sessions(self) -> int:
+        return self._sessions
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        addr = writer.get_extra_info('peername')
+        print('Connection attempt from %s:%i' % addr[:2])
+        if self._sessions >= self._maxSessions:
+            print('Session limit reached, refusing %s:%i' % addr[:2])
+            writer.close()
+            return
+        self._sessions += 1
+        try:
+            await AsyncSession(reader, writer, self).run()
+        finally:
+            self._sessions -= 1
+    def _wake(self) -> None:
+        self._admission.set()
+        self._admission = asyncio.Event()
+    async def admit(self, host: str) -> bool:
+        'Waits in the event loop for a transfer slot for host; False after the queue timeout.'
+        manager = self._transmissions
+        ticket = manager.enqueue(host)
+        async def wait():
+            while True:
+                changed = self._admission
+                if manager.claim(ticket):
+                    return
+                await changed.wait()
+        try:
+            await asyncio.wait_for(wait(), manager.queueTimeout())
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            manager.withdraw(ticket)
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._admission = asyncio.Event()
+        self._transmissions.listen(lambda: self._loop.call_soon_threadsafe(self._wake))
+        self._server = await asyncio.start_server(self._accept, sock=self._sock._socket, backlog=self._backlog)
+        async with self._server:
+            await self._server.serve_forever()
+    def serve(self, thread_join: bool = False) -> None:
+        if thread_join:
+            t = Thread(target=self.serve, name='ServerDaemon', daemon=True)
+            t.start()
+            return
+        try:
+            asyncio.run(self._serve())
+        except asyncio.CancelledError:
+            pass
+    def stop(self):
+        self._stopped = True
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._server.close)
\ No newline at end of file
@@ -0,0 +1,72 @@
+'''
+Compares the server-side CPU cost of serving a file the old way (read, MD5,
+framed send) against the sendfile based FetchEngine.
+
+    python benchmarks/fetch.py [size in MiB] [rounds]
+'''
+import os, sys, socket, tempfile, threading, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from hashlib import md5
+from structsock import StructuredSocket
+from fetch import FetchEngine, DigestCache
+
+CHUNK_SIZE = 1024*1024
+
+def drain(sock: socket.socket) -> None:
+    buffer = bytearray(2**20)
+    while sock.recv_into(buffer):
+        pass
+
+def legacy(sock: StructuredSocket, path: str) -> None:
+    stream = open(path, 'rb')
+    hasher = md5()
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk: break
+        hasher.update(chunk)
+        sock.send(chunk)
+    sock.send(hasher.digest())
+    stream.close()
+
+def engine(sock: StructuredSocket, path: str, fetch: FetchEngine) -> None:
+    with open(path, 'rb') as stream:
+        st = os.stat(path)
+        fetch.serve(sock, stream, 0, st.st_size, CHUNK_SIZE, fetch.digest(path, st))
+
+def measure(serve, path: str) -> tuple:
+    a, b = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(b,))
+    reader.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    serve(StructuredSocket(a), path)
+    a.close()
+    reader.join()
+    b.close()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    fd, path = tempfile.mkstemp()
+    for _ in range(size):
+        os.write(fd, os.urandom(CHUNK_SIZE))
+    os.close(fd)
+    gb = size / 1024
+    cached = FetchEngine(DigestCache())
+    modes = (
+        ('legacy', legacy),
+        ('sendfile (cold digest)', lambda sock, path: engine(sock, path, FetchEngine(DigestCache()))),
+        ('sendfile (cached digest)', lambda sock, path: engine(sock, path, cached)),
+    )
+    try:
+        for name, serve in modes:
+            results = [measure(serve, path) for _ in range(rounds)]
+            wall = min(r[0] for r in results)
+            cpu = min(r[1] for r in results)
+            # process time includes the draining reader, which is the same for every mode
+            print('%-26s %8.1f MB/s  %6.2f CPU s/GB' % (name, size / wall, cpu / gb))
+    finally:
+        os.unlink(path)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,50 @@
+'''
+Compares the per-chunk hashing cost of an upload: the old path that hashes
+every chunk with SHA384 for the signature and twice with MD5 (client) and
+once more on the server, against a single MD5 or a cheap negotiated frame
+checksum next to the signature hash.
+
+    python benchmarks/hashing.py [size in MiB] [rounds]
+'''
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from hashlib import md5
+from Crypto.Hash import SHA384
+import checksum
+
+CHUNK_SIZE = 1024*1024
+
+def legacy(chunks: list) -> None:
+    signature = SHA384.new()
+    for chunk in chunks:
+        signature.update(chunk)
+        md5(chunk).digest() # LocalSecurity.chunk
+        md5(chunk).digest() # the frame digest
+        md5(chunk).digest() # the server's check
+
+def fused(check: str):
+    def run(chunks: list) -> None:
+        signature = SHA384.new()
+        for chunk in chunks:
+            signature.update(chunk)
+            checksum.digest(check, chunk) # sent with the frame
+            checksum.digest(check, chunk) # the server's check
+    return run
+
+def measure(run, chunks: list) -> float:
+    start = time.perf_counter()
+    run(chunks)
+    return time.perf_counter() - start
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    chunks = [os.urandom(CHUNK_SIZE) for _ in range(size)]
+    modes = [('legacy sha384+3*md5', legacy)]
+    modes += [('sha384+%s' % name, fused(name)) for name in reversed(checksum.available())]
+    for name, run in modes:
+        wall = min(measure(run, chunks) for _ in range(rounds))
+        print('%-22s %8.1f MB/s' % (name, size / wall))
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
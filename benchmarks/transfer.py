@@ -0,0 +1,200 @@
+'''
+End-to-end benchmark of the transfer protocol over loopback: starts a
+Server on a temporary base directory with a freshly generated, pre-trusted
+key and drives uploads, fetches and listings from concurrent clients,
+optionally through a proxy that adds latency and simulated packet loss.
+Results go to JSON so that runs of different versions can be compared.
+
+    python benchmarks/transfer.py --size 64 --files 4 --clients 2 --latency 5 -o run.json
+'''
+import os, sys, argparse, json, random, socket, tempfile, threading, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import channels
+from channels import Server, Client, computer_name
+from security import LocalSecurity
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+MB = 1024*1024
+
+class LossyProxy:
+    '''
+    Relays TCP connections to target, delivering every block latency
+    seconds late. With probability loss a block is held back a further rto
+    seconds, which is what a lost segment costs a TCP stream.
+    '''
+    def __init__(self, target: tuple, latency: float, loss: float, rto: float=0.2):
+        self._target = target
+        self._latency = latency
+        self._loss = loss
+        self._rto = rto
+        self._sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self._sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+    def _accept(self) -> None:
+        while True:
+            client, _ = self._sock.accept()
+            server = socket.create_connection(self._target)
+            for a, b in ((client, server), (server, client)):
+                a.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._pipe(a, b)
+    def _pipe(self, source: socket.socket, sink: socket.socket) -> None:
+        queue, cond = [], threading.Condition()
+        def read():
+            due = 0.0
+            while True:
+                try:
+                    block = source.recv(MB)
+                except OSError:
+                    block = b''
+                delay = self._latency + (self._rto if random.random() < self._loss else 0)
+                due = max(due, time.monotonic() + delay) # TCP delivers in order
+                with cond:
+                    queue.append((due, block))
+                    cond.notify()
+                if not block: return
+        def write():
+            while True:
+                with cond:
+                    while not queue: cond.wait()
+                    due, block = queue.pop(0)
+                wait = due - time.monotonic()
+                if wait > 0: time.sleep(wait)
+                try:
+                    if not block:
+                        sink.shutdown(socket.SHUT_WR)
+                        return
+                    sink.sendall(block)
+                except OSError:
+                    return
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+class Progress:
+    'Turns progress callbacks into per-chunk latencies.'
+    def __init__(self):
+        self.latencies = []
+        self.reset()
+    def reset(self) -> None:
+        'Starts counting a new transfer.'
+        self._last = time.perf_counter()
+        self._done = 0
+    def __call__(self, done: int, total: int, *args) -> None:
+        now = time.perf_counter()
+        if done > self._done:
+            per_chunk = (now - self._last) / (done - self._done)
+            self.latencies += [per_chunk] * (done - self._done)
+            self._done, self._last = done, now
+
+def percentile(values: list, q: float) -> float:
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def faults() -> int:
+    # minor page faults: every freshly allocated chunk-sized buffer costs
+    # some, reused buffers none, so they count memory churn
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt if resource else 0
+
+def run_phase(name: str, clients: int, job) -> dict:
+    'Runs job(index) on clients threads and summarises bytes, wall time, CPU, page faults and latencies.'
+    results = [None] * clients
+    def work(i):
+        results[i] = job(i)
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(clients)]
+    wall, cpu, faulted = time.perf_counter(), time.process_time(), faults()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    wall, cpu, faulted = time.perf_counter() - wall, time.process_time() - cpu, faults() - faulted
+    moved = sum(r[0] for r in results)
+    latencies = [l for r in results for l in r[1]]
+    failures = sum(r[2] for r in results)
+    gb = moved / 1024**3
+    return {'phase': name, 'bytes': moved, 'seconds': wall, 'MB/s': moved / MB / wall if wall else 0.0,
+            # client and server share this process, so this is the CPU of both ends
+            'cpu_s/GB': cpu / gb if gb else 0.0, 'faults/MB': faulted / (moved / MB) if moved else 0.0, 'chunk_p50_ms': percentile(latencies, 0.5) * 1e3,
+            'chunk_p99_ms': percentile(latencies, 0.99) * 1e3, 'failures': failures}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=float, default=32, help='file size in MiB')
+    parser.add_argument('--files', type=int, default=4, help='files per client')
+    parser.add_argument('--clients', type=int, default=1, help='concurrent clients')
+    parser.add_argument('--chunk', type=float, default=channels.CHUNK_SIZE / MB, help='chunk size in MiB')
+    parser.add_argument('--window', type=int, default=channels.DEFAULT_WINDOW)
+    parser.add_argument('--streams', type=int, default=1)
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--latency', type=float, default=0, help='one way latency in ms, through a proxy')
+    parser.add_argument('--loss', type=float, default=0, help='fraction of blocks delayed as if lost')
+    parser.add_argument('--listings', type=int, default=20, help='fstree requests per client')
+    parser.add_argument('-o', '--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+    channels.CHUNK_SIZE = int(args.chunk * MB)
+    sys.stdout = open(os.devnull, 'w') # the server's progress lines
+
+    work = tempfile.mkdtemp()
+    os.chdir(work)
+    base = os.path.join(work, 'base')
+    os.mkdir(base)
+    security = LocalSecurity.generate()
+    server = Server(0, base, max_transfers=max(8, args.clients), per_host=args.clients)
+    server.trustHost(computer_name(), security.export().asBytes())
+    server.prepare()
+    server.serve(True)
+    port = server._sock.getsockname()[1]
+    if args.latency or args.loss:
+        port = LossyProxy(('127.0.0.1', port), args.latency / 1000, args.loss).port
+
+    size = int(args.size * MB)
+    sources = []
+    for i in range(args.files):
+        path = os.path.join(work, 'source%i' % i)
+        with open(path, 'wb') as f:
+            for _ in range(0, size, MB):
+                f.write(os.urandom(min(MB, size - f.tell())))
+        sources.append(path)
+
+    def connect() -> Client:
+        client = Client('127.0.0.1', port, security.fork())
+        client.connect()
+        return client
+    def upload(i):
+        client, progress, failures = connect(), Progress(), 0
+        for n, source in enumerate(sources):
+            progress.reset()
+            r = client.upload(source, ['c%i-%i' % (i, n)], progress, args.window, compress=args.compress, streams=args.streams)
+            failures += r.error()
+        return size * len(sources), progress.latencies, failures
+    def fetch(i):
+        client, progress, failures = connect(), Progress(), 0
+        for n in range(len(sources)):
+            progress.reset()
+            r = client.fetch(os.path.join(work, 'back%i-%i' % (i, n)), ['c%i-%i' % (i, n)], progress,
+                             resumable=False, compress=args.compress, streams=args.streams)
+            failures += r.error()
+        return size * len(sources), progress.latencies, failures
+    def listing(i):
+        client, latencies, failures = connect(), [], 0
+        for _ in range(args.listings):
+            start = time.perf_counter()
+            failures += client.fileSystem(None).error()
+            latencies.append(time.perf_counter() - start)
+        return 0, latencies, failures
+
+    results = {'config': vars(args), 'python': sys.version.split()[0], 'results': [
+        run_phase('upload', args.clients, upload),
+        run_phase('fetch', args.clients, fetch),
+        run_phase('fstree', args.clients, listing),
+    ]}
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text, file=sys.__stdout__)
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
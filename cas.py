@@ -0,0 +1,122 @@
+import hashlib, os, shutil, tempfile
+from typing import Callable, Iterable, List, Optional, Tuple
+from Crypto.Hash import SHA384
+
+# dedup only works if every client cuts files the same way, so this does
+# not follow channels.CHUNK_SIZE
+CHUNK_SIZE = 1024*1024
+DIGEST = hashlib.sha256
+
+def digest(data: bytes) -> bytes:
+    return DIGEST(data).digest()
+
+class ChunkStore:
+    '''
+    Content addressed chunks below root, named by their SHA-256. Files
+    assembled from chunks are kept as well, named by the hash of their chunk
+    list, so a file uploaded again costs neither bandwidth nor (with link
+    set) disk: the destination becomes a hard link to the stored copy.
+    '''
+    def __init__(self, root: str, link: bool=True):
+        self._root = root
+        self._link = link
+        for sub in ('chunks', 'files', 'tmp'):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+    def root(self) -> str:
+        return self._root
+    def _chunkPath(self, key: bytes) -> str:
+        name = key.hex()
+        return os.path.join(self._root, 'chunks', name[:2], name)
+    def _filePath(self, keys: List[bytes]) -> str:
+        return os.path.join(self._root, 'files', digest(b''.join(keys)).hex())
+    def has(self, key: bytes) -> bool:
+        return os.path.isfile(self._chunkPath(key))
+    def missing(self, keys: Iterable[bytes]) -> List[int]:
+        'Indices of the keys without a stored chunk; each missing key is listed once.'
+        seen, missing = set(), []
+        for i, key in enumerate(keys):
+            if key not in seen and not self.has(key):
+                missing.append(i)
+            seen.add(key)
+        return missing
+    def _temp(self) -> Tuple[int, str]:
+        return tempfile.mkstemp(dir=os.path.join(self._root, 'tmp'))
+    def put(self, key: bytes, data: bytes) -> bool:
+        'Stores a chunk if it matches its key; returns whether it did.'
+        if digest(data) != key:
+            return False
+        path = self._chunkPath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = self._temp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+        return True
+    def read(self, key: bytes) -> bytes:
+        with open(self._chunkPath(key), 'rb') as f:
+            return f.read()
+    def _intact(self, path: str, keys: List[bytes], hasher: SHA384.SHA384Hash) -> bool:
+        # a stored file is hard linked to its destinations, so whoever edits
+        # one of them in place edits it too
+        count = 0
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                if count >= len(keys) or digest(block) != keys[count]:
+                    return False
+                hasher.update(block)
+                count += 1
+        return count == len(keys)
+    def assemble(self, keys: List[bytes]) -> Tuple[str, SHA384.SHA384Hash]:
+        '''
+        The stored file made of the chunks, assembling it first if needed,
+        and the SHA384 hash of its content for checking the signature. A
+        stored file that no longer matches its chunks is assembled again.
+        '''
+        path = self._filePath(keys)
+        if os.path.isfile(path):
+            hasher = SHA384.new()
+            if self._intact(path, keys, hasher):
+                return path, hasher
+            os.unlink(path) # its destinations keep the changed copy
+        hasher = SHA384.new()
+        fd, temp = self._temp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for key in keys:
+                    data = self.read(key)
+                    hasher.update(data)
+                    f.write(data)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        return path, hasher
+    def place(self, source: str, destination: str) -> None:
+        'Puts a stored file at destination, as a hard link where possible.'
+        directory = os.path.dirname(destination)
+        fd, temp = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+        try:
+            if self._link:
+                try:
+                    os.unlink(temp)
+                    os.link(source, temp)
+                except OSError: # other device, or links not supported
+                    shutil.copyfile(source, temp)
+            else:
+                shutil.copyfile(source, temp)
+            os.replace(temp, destination)
+        except BaseException:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            raise
+
+def chunk_keys(path: str, feed: Optional[Callable[[bytes], None]]=None) -> List[bytes]:
+    'The chunk keys of a local file, passing every chunk to feed as well.'
+    keys = []
+    with open(path, 'rb') as stream:
+        for data in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            keys.append(digest(data))
+            if feed:
+                feed(data)
+    return keys
\ No newline at end of file
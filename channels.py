@@ -1,34 +1,90 @@
-import socket, msgpack, platform, os, math, tempfile, shutil
+import socket, msgpack, platform, os, math, tempfile, shutil, struct, hashlib, json, itertools, select
 from response import Response, RespCode
-from security import HostKeyMap, LocalSecurity, random_password, encrypt, decrypt, derive_key
-from transmit import Transmitter, IntegrityError
-from threading import Thread
-from typing import List, Union, Optional, Callable
+from security import TrustStore, LocalSecurity, random_password, encrypt, decrypt, derive_key
+from transmit import TransmissionManager, Transmitter, BatchTransmitter, RangeTransmitter, ByteRange, ChunkWriter, IntegrityError, pwrite, SYNC_NONE
+from fetch import FetchEngine, DigestCache
+from fs import FileSystem
+from cas import ChunkStore
+import compression, checksum, metrics, delta, cas
+from chunking import ChunkSizer
+from threading import Thread, Lock
+from collections import deque
+from time import perf_counter, monotonic
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Union, Optional, Callable, Iterator, Tuple
 from hashlib import md5
-from structsock import PeerDisconnect, StructuredSocket
+from Crypto.Hash import SHA384
+from structsock import PeerDisconnect
+from framing import BufferPool, FrameSocket
 import structsock
 
 structsock.RECV_SIZE = 2**16
 
 MD5_DIGEST_SIZE = 16
 CHUNK_SIZE = 1024*1024
+# largest chunk a peer may decompress to
+MAX_CHUNK_SIZE = 16*1024*1024
+# windowed uploads: (sequence number, flags) before every chunk
+FRAME_HEADER = struct.Struct('>IB')
+FLAG_COMPRESSED = 1
+# adaptive transfers: chunks of any size, ended by a frame with this flag
+# whose sequence number is the chunk count
+FLAG_END = 2
+DEFAULT_WINDOW = 8
+MAX_WINDOW = 32
+# fstree requests carrying any of these get paged entries with metadata
+FSTREE_OPTIONS = {'depth', 'limit', 'cursor', 'meta', 'stream'}
+FSTREE_PAGE = 1000
+FSTREE_MAX_PAGE = 10000
+FSTREE_MAX_DEPTH = 64
+# files smaller than this always go over a single connection
+PARALLEL_MIN_SIZE = 16*CHUNK_SIZE
+# delta uploads: signature pages from the server, then literal data, runs
+# of the server's blocks (first, count) and an end frame from the client
+DELTA_PAGE = 4096
+DELTA_LITERAL, DELTA_BLOCKS, DELTA_END = b'L', b'B', b'E'
+DELTA_RUN = struct.Struct('>II')
+# directory fetches: a header per entry, a file's data frames and its
+# checksum, error records for entries that cannot be read, an end record
+TREE_ENTRY, TREE_DATA, TREE_FILE_END, TREE_ERROR, TREE_END = b'H', b'D', b'F', b'X', b'E'
+# the chunk store of a deduplicating server, below its base directory
+CAS_DIR = '.cas'
+# threads verifying (and decompressing) upload frames, shared by all
+# sessions; hashlib and zlib release the GIL on large buffers
+VERIFY_WORKERS = min(8, os.cpu_count() or 1)
+# interrupted uploads are kept this long for resumption
+JOURNAL_MAX_AGE = 7*24*3600
 
 def computer_name() -> str:
     name = platform.node() or socket.getfqdn(socket.gethostname())
     return name
 
 class Session:
-    def __init__(self, client: StructuredSocket, server: 'Server'):
+    def __init__(self, client: FrameSocket, server: 'Server'):
         self._client = client
         self._authorized = False
         self._server = server
         self._host = None
-        self._basedir = server.basedir
+        self._fs = server.fileSystem()
+        self._metrics = metrics.Metrics(server.metrics())
     def _recv(self) -> bytes:
-        return self._client.recv()
+        data = self._client.recv()
+        self._metrics.add('bytes_in', len(data))
+        return data
+    def _recvBuffer(self) -> Tuple[memoryview, Optional[bytearray]]:
+        'The next frame in a pooled buffer: (view, buffer), the buffer to be released to the server\'s pool.'
+        view, buffer = self._client.recvInto(self._server.buffers())
+        self._metrics.add('bytes_in', len(view))
+        return view, buffer
     def _send(self, data: Union[bytes, Response]) -> None:
         data = bytes(data)
         self._client.send(data)
+        self._metrics.add('bytes_out', len(data))
+    def _sendParts(self, *parts) -> None:
+        'Sends the parts as one frame, without joining them first.'
+        self._client.sendParts(*parts)
+        self._metrics.add('bytes_out', sum(len(part) for part in parts))
     def _requireAuth(self) -> bool:
         if not self._authorized:
             self._send(Response(RespCode.RCE_UNAUTHORIZED))
@@ -41,7 +97,7 @@ class Session:
             self._authorized = True
             self._send(Response.ok())
             print('Authorized host connection:', name)
-            print('Key identifier:', self._server.transmitter().trusted().identifierOf(name))
+            print('Key identifier:', self._server.transmissions().trusted().identifierOf(name))
         else:
             self._send(Response.okbu())
             print('Unauthorized host connection:', name)
@@ -50,54 +106,101 @@ class Session:
             data = self._recv()
             data = msgpack.unpackb(data)
             self._data(data)
+    def _resolve(self, path: Union[str, List[str], None]) -> Optional[str]:
+        path = self._fs.resolve(path)
+        if path is None:
+            self._send(Response(RespCode.RCE_INVALID_FSPATH))
+        return path
     def _data(self, data: dict):
         op = data['type']
         if op == 'register':
             self._register()
         elif op == 'upload':
             if not self._requireAuth(): return
-            path = data['dest']
-            path = os.path.join(self._basedir, *path)
-            if not path.startswith(self._basedir):
-                self._send(Response(RespCode.RCE_INVALID_FSPATH))
-                return
+            path = self._resolve(data['dest'])
+            if path is None: return
             total = data['total']
-            self._upload(path, total)
+            self._upload(path, total, data.get('window'), data.get('resume'), compression.negotiate(data.get('compress')), checksum.negotiate(data.get('check')), bool(data.get('adaptive')), data.get('size'))
+        elif op == 'parallel_upload':
+            if not self._requireAuth(): return
+            path = self._resolve(data['dest'])
+            if path is None: return
+            self._parallelUpload(path, data['size'], data['ranges'])
+        elif op == 'upload_range':
+            if not self._requireAuth(): return
+            self._uploadRange(data)
+        elif op == 'stat':
+            path = self._resolve(data['path'])
+            if path is None: return
+            self._stat(path)
+        elif op == 'batch_upload':
+            if not self._requireAuth(): return
+            self._batchUpload(data)
         elif op == 'fstree':
-            path = data.get('path')
-            if path is None:
-                path = self._basedir
+            path = self._resolve(data.get('path'))
+            if path is None: return
+            if FSTREE_OPTIONS.intersection(data):
+                self._fstreePages(path, data)
             else:
-                path = os.path.join(self._basedir, *path)
-            if not path.startswith(self._basedir):
-                self._send(Response(RespCode.RCE_INVALID_FSPATH))
+                self._fstree(path)
+        elif op == 'cas_upload':
+            if not self._requireAuth(): return
+            if self._server.chunkStore() is None:
+                self._send(Response(RespCode.RCE_NO_SUCH_COMMAND))
                 return
-            self._fstree(path)
+            path = self._resolve(data['dest'])
+            if path is None: return
+            self._casUpload(path, data['keys'])
+        elif op == 'delta_upload':
+            if not self._requireAuth(): return
+            path = self._resolve(data['dest'])
+            if path is None: return
+            self._deltaUpload(path)
+        elif op == 'stats':
+            if not self._requireAuth(): return
+            self._send(Response.ok(msgpack.packb({'session': self._metrics.snapshot(), 'server': self._server.metrics().snapshot()})))
+        elif op == 'fetch_tree':
+            path = self._resolve(data.get('path'))
+            if path is None: return
+            self._fetchTree(path, compression.negotiate(data.get('compress')), checksum.negotiate(data.get('check')))
         elif op == 'fetch':
-            path = data['path']
-            path = os.path.join(self._basedir, path)
-            if not path.startswith(self._basedir):
-                print(path)
-                self._send(Response(RespCode.RCE_INVALID_FSPATH))
-                return
-            self._fetch(path)
+            path = self._resolve(data['path'])
+            if path is None: return
+            if 'offset' in data:
+                self._fetchFrom(path, data['offset'], data.get('resume'), compression.negotiate(data.get('compress')), data.get('length'), checksum.negotiate(data.get('check')), bool(data.get('adaptive')))
+            else:
+                self._fetch(path)
         else:
             self._send(Response(RespCode.RCE_NO_SUCH_COMMAND))
     def _fstree(self, path: str) -> None:
-        files, dirs = [], []
-        cur = os.getcwd()
         try:
-            os.chdir(path)
-            for entry in os.listdir():
-                if os.path.isfile(entry): files.append(entry)
-                elif os.path.isdir(entry): dirs.append(entry)
-            base = path == self._basedir
+            files, dirs = self._fs.listdir(path)
+            base = self._fs.isBase(path)
             data = msgpack.packb({'files': files, 'dirs': dirs, 'base': base})
             self._send(Response.ok(data))
         except PermissionError:
             self._send(Response(RespCode.RCE_ACCESS_DENIED))
-        finally:
-            os.chdir(cur)
+    def _fstreePages(self, path: str, options: dict) -> None:
+        depth = max(1, min(options.get('depth', 1), FSTREE_MAX_DEPTH))
+        limit = max(1, min(options.get('limit', FSTREE_PAGE), FSTREE_MAX_PAGE))
+        cursor = options.get('cursor') or 0
+        meta = options.get('meta', False)
+        try:
+            entries = self._fs.walk(path, depth) # stat only what goes into a page, not what the cursor skips
+            for _ in itertools.islice(entries, cursor): pass
+            base = self._fs.isBase(path)
+            while True:
+                walked = list(itertools.islice(entries, limit))
+                cursor += len(walked)
+                more = len(walked) == limit
+                if meta:
+                    walked = self._fs.stat(path, walked)
+                page = [[list(relative), entry.dir, entry.size, entry.mtime] for relative, entry in walked]
+                self._send(Response.ok(msgpack.packb({'entries': page, 'cursor': cursor if more else None, 'base': base})))
+                if not more or not options.get('stream'):
+                    break
+        except PermissionError:
+            self._send(Response(RespCode.RCE_ACCESS_DENIED))
     def _register(self) -> None:
         if self._authorized:
             self._send(Response(RespCode.RCE_REGISTER_TWICE))
@@ -108,19 +211,16 @@ class Session:
         data = self._recv()
         try:
             data = decrypt(derived, data)
-            self._server.trustHost(self._host, data)    
-            print('Added', self._host, 'to trusted hosts.')
-            print('Key identifier is', self._server.transmitter().trusted().identifierOf(self._host))
+            if self._server.trustHost(self._host, data):
+                print('Added', self._host, 'to trusted hosts.')
+            else:
+                print(self._host, 'was already trusted with this key.')
+            print('Key identifier is', self._server.transmissions().trusted().identifierOf(self._host))
             self._send(Response.ok())
             self._authorized = True
         except Exception:
             self._send(Response(RespCode.RCE_WRONG_PASSWORD))
-    def _upload(self, destination: str, chunks: int) -> None:
-        t = self._server.transmitter()
-        if not t.transmission(self._host, destination):
-            self._send(Response(RespCode.RCE_TRANSMITTER_OCCUPIED))
-            return
-        self._send(Response.ok())
+    def _receiveChunks(self, t: Transmitter, chunks: int) -> None:
         for i in range(chunks):
             print('\rUploading %i of %i chunks...' % (i+1, chunks), end='')
             while True:
@@ -129,36 +229,379 @@ class Session:
                 try:
                     t.chunk(chunk, digest)
                 except IntegrityError:
+                    self._metrics.add('integrity_retries')
                     self._send(Response(RespCode.RCE_INTEGRITY_FAIL))
                     continue # retry
                 else:
+                    self._metrics.add('chunks_in')
                     self._send(Response.ok())
                     break
-        print('\nUploaded %i chunks.' % chunks)
-        signature = self._recv()
+    def _verifyFrame(self, chunk: bytes, digest: bytes, flags: int, codec: Optional[str], check: str) -> Optional[bytes]:
+        # runs on the server's verify pool; the chunk, or None if it is broken
+        started = perf_counter()
+        try:
+            if flags & FLAG_COMPRESSED:
+                try:
+                    chunk = compression.decompress(codec, chunk, MAX_CHUNK_SIZE)
+                except Exception:
+                    return None
+            return chunk if checksum.digest(check, chunk) == digest else None
+        finally:
+            self._metrics.observe('time.checksum', perf_counter() - started)
+    def _receiveWindow(self, t: Union[Transmitter, BatchTransmitter, ByteRange], chunks: Optional[int], window: int, codec: Optional[str]=None, check: str=checksum.DEFAULT) -> None:
+        # chunks is None for adaptive transfers until the end frame tells it.
+        # Frames are verified on the server's pool and written by a
+        # ChunkWriter while this thread goes on receiving. A frame is answered
+        # once it is verified, which may be after later frames arrived, but
+        # never so late that the sender runs out of window waiting for it.
+        expected = t.chunks() # the next chunk for the writer, also the ack
+        highest = expected # one past the last chunk received
+        pending = {} # verified, waiting for an earlier chunk
+        verifying = deque()
+        size = checksum.size(check)
+        pool = self._server.verifyPool()
+        buffers = self._server.buffers()
+        # frames are received into pooled buffers, which go back once the
+        # chunk is written, so a steady transfer allocates no chunk memory
+        writer = ChunkWriter(t, window, self._metrics, buffers.release)
+        def answer(block: bool) -> None:
+            nonlocal expected
+            while verifying and (block or verifying[0][1].done()):
+                block = False
+                seq, future, digest, buffer = verifying.popleft()
+                chunk = future.result()
+                if chunk is None:
+                    buffers.release(buffer)
+                    self._metrics.add('integrity_retries')
+                    self._send(Response(RespCode.RCE_INTEGRITY_FAIL, msgpack.packb({'ack': expected, 'resend': seq})))
+                    continue
+                pending[seq] = chunk, digest, buffer
+                while expected in pending:
+                    writer.put(*pending.pop(expected))
+                    expected += 1
+                print('\rUploading %i of %s chunks...' % (expected, chunks or '?'), end='')
+                if expected == chunks:
+                    # after the last ack the sender may finish the transfer,
+                    # which for a range happens on another connection
+                    writer.drain()
+                self._send(Response.ok(msgpack.packb({'ack': expected})))
+        try:
+            while chunks is None or expected < chunks:
+                if verifying and (highest - expected >= window or highest == chunks):
+                    answer(True) # the sender may be waiting for this
+                    continue
+                answer(False)
+                started = perf_counter()
+                data, buffer = self._recvBuffer()
+                self._metrics.observe('time.socket', perf_counter() - started)
+                seq, flags = FRAME_HEADER.unpack_from(data)
+                chunk, digest = data[FRAME_HEADER.size:-size], bytes(data[-size:])
+                if flags & FLAG_END and chunks is None and seq >= highest:
+                    buffers.release(buffer)
+                    chunks = seq
+                    self._send(Response.ok(msgpack.packb({'ack': expected})))
+                    continue
+                if not expected <= seq < min(expected + window, chunks if chunks is not None else seq + 1):
+                    # duplicate or outside the negotiated window
+                    buffers.release(buffer)
+                    self._send(Response.ok(msgpack.packb({'ack': expected})))
+                    continue
+                highest = max(highest, seq + 1)
+                verifying.append((seq, pool.submit(self._verifyFrame, chunk, digest, flags, codec, check), digest, buffer))
+            while verifying: # answers owed for frames sent twice
+                answer(True)
+        finally:
+            writer.close()
+    def _complete(self, t: Union[Transmitter, BatchTransmitter, RangeTransmitter], receive: Callable[[], None]) -> None:
+        try:
+            receive()
+            signature = self._recv()
+        except PeerDisconnect:
+            t.suspend()
+            raise
+        except Exception:
+            t.abort()
+            raise
         try:
             if t.finish(signature):
+                self._metrics.add('uploads')
                 self._send(Response.ok())
             else:
+                self._metrics.add('signature_failures')
                 self._send(Response(RespCode.RCE_SIGNATURE_MISMATCH))
         except PermissionError:
             self._send(Response(RespCode.RCE_ACCESS_DENIED))
+        except OSError: # the destination is a directory, or its directory is missing
+            self._send(Response(RespCode.RCE_INVALID_FSPATH))
+    def _upload(self, destination: str, chunks: int, window: Optional[int]=None, resume: Optional[str]=None, codec: Optional[str]=None, check: str=checksum.DEFAULT, adaptive: bool=False, size: Optional[int]=None) -> None:
+        t = self._server.transmissions().transmission(self._host, destination, chunks, bool(window), resume, check, size)
+        if t is None:
+            self._send(Response(RespCode.RCE_TRANSMITTER_OCCUPIED))
+            return
+        def receive():
+            if window:
+                accepted = max(1, min(window, MAX_WINDOW))
+                info = {'window': accepted, 'id': t.id(), 'offset': t.chunks(), 'compress': codec, 'check': check}
+                if adaptive:
+                    info.update(adaptive=True, position=t.size())
+                self._send(Response.ok(msgpack.packb(info)))
+                self._receiveWindow(t, None if adaptive else chunks, accepted, codec, check)
+            else:
+                self._send(Response.ok())
+                self._receiveChunks(t, chunks)
+            print('\nUploaded %i chunks.' % t.chunks())
+        self._complete(t, receive)
+    def _batchUpload(self, data: dict) -> None:
+        dest = list(data['dest'])
+        manifest = data['manifest']
+        files, dirs = [], []
+        for parts, size in msgpack.unpackb(manifest):
+            path = self._fs.resolve(dest + parts)
+            if path is None or path == self._fs.basedir():
+                self._send(Response(RespCode.RCE_INVALID_FSPATH))
+                return
+            if size is None:
+                dirs.append(path)
+            else:
+                files.append((path, size))
+        t = self._server.transmissions().batch(self._host, manifest, files, dirs)
+        if t is None:
+            self._send(Response(RespCode.RCE_TRANSMITTER_OCCUPIED))
+            return
+        chunks = data['total']
+        codec = compression.negotiate(data.get('compress'))
+        check = checksum.negotiate(data.get('check'))
+        def receive():
+            window = max(1, min(data.get('window', 1), MAX_WINDOW))
+            self._send(Response.ok(msgpack.packb({'window': window, 'compress': codec, 'check': check})))
+            self._receiveWindow(t, chunks, window, codec, check)
+            print('\nUploaded %i files in %i chunks.' % (len(files), chunks))
+        self._complete(t, receive)
+    def _sendFile(self, stream, offset: int, end: int, digest: Future, sizer: Optional[ChunkSizer]=None) -> None:
+        frames = self._server.fetchEngine().serve(self._client, stream, offset, end, CHUNK_SIZE, digest, sizer)
+        self._fileSent(end - offset, frames)
+    def _fileSent(self, length: int, frames: int) -> None:
+        self._metrics.add('bytes_out', length)
+        self._metrics.add('chunks_out', frames)
+        self._metrics.add('fetches')
     def _fetch(self, path: str) -> None:
         try:
-            size = os.path.getsize(path)
-            total = math.ceil(size / CHUNK_SIZE)
-            self._send(Response.ok(str(total)))
+            st = os.stat(path)
             stream = open(path, 'rb')
-            hasher = md5()
-            while True:
-                chunk = stream.read(CHUNK_SIZE)
-                if not chunk: break
-                hasher.update(chunk)
-                self._send(chunk)
-            self._send(hasher.digest())
-            stream.close()
         except PermissionError:
             self._send(Response(RespCode.RCE_ACCESS_DENIED))
+            return
+        except FileNotFoundError:
+            self._send(Response(RespCode.RCE_INVALID_FSPATH))
+            return
+        with stream:
+            self._send(Response.ok(str(math.ceil(st.st_size / CHUNK_SIZE))))
+            self._sendFile(stream, 0, st.st_size, self._server.fetchEngine().digest(path, st))
+    def _sendCompressed(self, stream, offset: int, end: int, digest: Future, codec: str, sizer: Optional[ChunkSizer]=None) -> None:
+        compressor = compression.Compressor(codec)
+        stream.seek(offset)
+        while offset < end:
+            chunk = stream.read(min(sizer.size() if sizer else CHUNK_SIZE, end - offset))
+            if not chunk: break
+            offset += len(chunk)
+            packed = compressor.compress(chunk)
+            if packed is None:
+                self._send(bytes([0]) + chunk)
+            else:
+                self._send(bytes([FLAG_COMPRESSED]) + packed)
+            self._metrics.add('chunks_out')
+            if sizer:
+                sizer.transferred(len(chunk))
+        if sizer:
+            self._send(b'')
+        self._send(digest.result())
+        self._metrics.add('fetches')
+    def _fetchTree(self, path: str, codec: Optional[str], check: str) -> None:
+        # streams the tree as it is walked, so memory does not grow with it
+        if not os.path.isdir(path):
+            self._send(Response(RespCode.RCE_INVALID_FSPATH))
+            return
+        try:
+            self._fs.entries(path) # walk reports errors below the root only
+        except PermissionError:
+            self._send(Response(RespCode.RCE_ACCESS_DENIED))
+            return
+        self._send(Response.ok(msgpack.packb({'compress': codec, 'check': check})))
+        compressor = compression.Compressor(codec) if codec else None
+        files = errors = 0
+        def error(relative: tuple, e: OSError) -> None:
+            nonlocal errors
+            errors += 1
+            self._send(TREE_ERROR + msgpack.packb({'path': list(relative), 'error': e.strerror or str(e)}))
+        for relative, entry in self._fs.walk(path, FSTREE_MAX_DEPTH, onerror=error):
+            if entry.dir:
+                self._send(TREE_ENTRY + msgpack.packb({'path': list(relative), 'dir': True, 'size': 0, 'mtime': None}))
+                if len(relative) == FSTREE_MAX_DEPTH: # walk stops here
+                    error(relative, OSError('more than %i levels deep' % FSTREE_MAX_DEPTH))
+                continue
+            try:
+                stream = open(os.path.join(path, *relative), 'rb')
+            except OSError as e:
+                error(relative, e)
+                continue
+            with stream:
+                # the listing may be older than the file, the open file is not
+                st = os.fstat(stream.fileno())
+                self._send(TREE_ENTRY + msgpack.packb({'path': list(relative), 'dir': False, 'size': st.st_size, 'mtime': st.st_mtime}))
+                hasher = checksum.new(check)
+                try:
+                    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                        hasher.update(chunk)
+                        # a flag byte leads the data when compression was negotiated
+                        packed = compressor and compressor.compress(chunk)
+                        if not compressor:
+                            self._sendParts(TREE_DATA, chunk)
+                        elif packed is None:
+                            self._sendParts(TREE_DATA, b'\0', chunk)
+                        else:
+                            self._sendParts(TREE_DATA, bytes([FLAG_COMPRESSED]), packed)
+                        self._metrics.add('chunks_out')
+                except OSError as e: # the client drops what it got of the file
+                    error(relative, e)
+                    continue
+            self._send(TREE_FILE_END + hasher.digest())
+            files += 1
+        print('Sent %i files of %s, %i entries skipped.' % (files, path, errors))
+        self._send(TREE_END + msgpack.packb({'files': files, 'errors': errors}))
+        self._metrics.add('fetches')
+    @staticmethod
+    def _version(path: str, st: os.stat_result) -> str:
+        return hashlib.sha256(('%s:%i:%i' % (path, st.st_size, st.st_mtime_ns)).encode()).hexdigest()[:32]
+    def _stat(self, path: str) -> None:
+        try:
+            st = os.stat(path)
+        except PermissionError:
+            self._send(Response(RespCode.RCE_ACCESS_DENIED))
+            return
+        except FileNotFoundError:
+            self._send(Response(RespCode.RCE_INVALID_FSPATH))
+            return
+        self._send(Response.ok(msgpack.packb({'id': self._version(path, st), 'size': st.st_size, 'mtime': st.st_mtime})))
+    def _fetchFrom(self, path: str, offset: int, resume: Optional[str]=None, codec: Optional[str]=None, length: Optional[int]=None, check: str=checksum.DEFAULT, adaptive: bool=False) -> None:
+        try:
+            st = os.stat(path)
+            transfer_id = self._version(path, st)
+            if length is not None:
+                # one range of a parallel fetch, which must all see the same file
+                if resume != transfer_id or not 0 <= offset <= offset + length <= st.st_size:
+                    self._send(Response(RespCode.RCE_TRANSFER_UNKNOWN))
+                    return
+                start, end = offset, offset + length
+            else:
+                if resume != transfer_id or not 0 <= offset <= st.st_size:
+                    offset = 0 # file changed since the interrupted fetch
+                # the digest covers the whole file so the client can check
+                # its resumed prefix as well
+                start, end = 0, st.st_size
+            total = math.ceil((end - offset) / CHUNK_SIZE)
+            stream = open(path, 'rb')
+        except PermissionError:
+            self._send(Response(RespCode.RCE_ACCESS_DENIED))
+            return
+        except FileNotFoundError:
+            self._send(Response(RespCode.RCE_INVALID_FSPATH))
+            return
+        with stream:
+            self._send(Response.ok(msgpack.packb({'id': transfer_id, 'offset': offset, 'size': st.st_size, 'total': total, 'compress': codec, 'check': check, 'adaptive': adaptive})))
+            digest = self._server.fetchEngine().digest(path, st, start, end, check)
+            sizer = ChunkSizer(CHUNK_SIZE, MAX_CHUNK_SIZE) if adaptive else None
+            if codec:
+                self._sendCompressed(stream, offset, end, digest, codec, sizer)
+            else:
+                self._sendFile(stream, offset, end, digest, sizer)
+    def _casUpload(self, destination: str, keys: List[bytes]) -> None:
+        t = self._server.transmissions().stored(self._host, destination, self._server.chunkStore(), keys)
+        if t is None:
+            self._send(Response(RespCode.RCE_TRANSMITTER_OCCUPIED))
+            return
+        missing = t.missing()
+        corrupt = []
+        def receive():
+            self._send(Response.ok(msgpack.packb({'missing': missing})))
+            for index in missing:
+                try:
+                    t.put(index, self._recv())
+                except IntegrityError:
+                    corrupt.append(index) # not stored, so a retry sends it again
+            self._metrics.add('dedup_chunks_skipped', len(keys) - len(missing))
+            print('Received %i of %i chunks for %s.' % (len(missing), len(keys), destination))
+            if corrupt:
+                raise IntegrityError
+        try:
+            self._complete(t, receive)
+        except IntegrityError:
+            self._recv() # the signature, useless without the chunks
+            self._send(Response(RespCode.RCE_INTEGRITY_FAIL, msgpack.packb({'corrupt': corrupt})))
+    def _deltaUpload(self, destination: str) -> None:
+        try:
+            old = open(destination, 'rb') if os.path.isfile(destination) else None
+        except PermissionError:
+            self._send(Response(RespCode.RCE_ACCESS_DENIED))
+            return
+        size = os.fstat(old.fileno()).st_size if old else 0
+        block = delta.block_size(size)
+        t = self._server.transmissions().transmission(self._host, destination)
+        if t is None:
+            if old: old.close()
+            self._send(Response(RespCode.RCE_TRANSMITTER_OCCUPIED))
+            return
+        def receive():
+            try:
+                count = math.ceil(size / block)
+                self._send(Response.ok(msgpack.packb({'block': block, 'count': count})))
+                signatures = delta.signatures(destination, block) if old else iter(())
+                for _ in range(math.ceil(count / DELTA_PAGE)):
+                    self._send(b''.join(itertools.islice(signatures, DELTA_PAGE)))
+                while True:
+                    frame = self._recv()
+                    kind = frame[:1]
+                    if kind == DELTA_LITERAL:
+                        t.write(frame[1:])
+                        self._metrics.add('delta_literal_bytes', len(frame) - 1)
+                    elif kind == DELTA_BLOCKS and old:
+                        first, run = DELTA_RUN.unpack_from(frame, 1)
+                        old.seek(first * block)
+                        remaining = run * block
+                        while remaining:
+                            data = old.read(min(CHUNK_SIZE, remaining))
+                            if not data: break # the signature check will fail
+                            t.write(data)
+                            remaining -= len(data)
+                            self._metrics.add('delta_copied_bytes', len(data))
+                    elif kind == DELTA_END:
+                        break
+                    else:
+                        raise IntegrityError('bad delta frame')
+            finally:
+                if old: old.close() # before finish replaces the file
+            print('\nRebuilt %s from a delta.' % destination)
+        self._complete(t, receive)
+    def _parallelUpload(self, destination: str, size: int, ranges: List[List[int]]) -> None:
+        try:
+            t = self._server.transmissions().ranged(self._host, destination, size, ranges)
+        except ValueError:
+            self._send(Response.failed('invalid ranges'))
+            return
+        if t is None:
+            self._send(Response(RespCode.RCE_TRANSMITTER_OCCUPIED))
+            return
+        # the ranges arrive over other connections, this one only waits for the signature
+        self._complete(t, lambda: self._send(Response.ok(msgpack.packb({'id': t.id()}))))
+    def _uploadRange(self, data: dict) -> None:
+        r = self._server.transmissions().range(data['id'], self._host, data['index'])
+        if r is None:
+            self._send(Response(RespCode.RCE_TRANSFER_UNKNOWN))
+            return
+        codec = compression.negotiate(data.get('compress'))
+        check = checksum.negotiate(data.get('check'))
+        window = max(1, min(data.get('window', 1), MAX_WINDOW))
+        self._send(Response.ok(msgpack.packb({'window': window, 'compress': codec, 'check': check})))
+        self._receiveWindow(r, data['total'], window, codec, check)
     def lifecycle(self, multithread: bool=False) -> None:
     
         if multithread:
@@ -171,23 +614,56 @@ class Session:
         except PeerDisconnect:
             print(self._host or 'Unknown host', 'has disconnected.')
             self._client.close()
-            self._server.transmitter().trusted().save('verified')
+        except BaseException:
+            self._client.close() # or the client waits for an answer forever
+            raise
+
+# hot paths timed when a server is started with profile=True
+PROFILED = ((Transmitter, 'chunk'), (Transmitter, 'write'), (Session, '_fetch'), (Session, '_fetchFrom'),
+            (FrameSocket, 'sendParts'), (FrameSocket, 'recv'), (FrameSocket, 'recvInto'), (DigestCache, '_compute'))
 
 class Server:
-    def __init__(self, port: int, basedir: str='D:\\'):
-        self._transmitter = Transmitter(HostKeyMap.scan('verified'))
-        self._sock = StructuredSocket()
+    def __init__(self, port: int, basedir: str='D:\\', max_transfers: int=8, per_host: int=2, queue_timeout: Optional[float]=None, backlog: int=128, profile: bool=False, dedup: bool=False, sync: str=SYNC_NONE):
+        self._metrics = metrics.Metrics()
+        if profile:
+            metrics.instrument(PROFILED, self._metrics)
+        trusted = TrustStore('verified.db')
+        if os.path.isdir('verified'):
+            migrated = trusted.migrate('verified')
+            if migrated:
+                print('Migrated', migrated, 'trusted hosts from verified/.')
+        self._transmissions = TransmissionManager(trusted, max_transfers, per_host, queue_timeout, 'partial', self._metrics, sync)
+        self._transmissions.purge(JOURNAL_MAX_AGE)
+        self._fetchEngine = FetchEngine(DigestCache())
+        self._verifyPool = ThreadPoolExecutor(VERIFY_WORKERS, thread_name_prefix='Verify')
+        self._buffers = BufferPool()
+        self._sock = FrameSocket()
         self._sock.bind(('0.0.0.0', port))
         self._stopped = False
-        self.basedir = basedir
-    def trustHost(self, host: str, key: bytes):
-        self._transmitter.trusted().makeTrust(host, key)
+        self._backlog = backlog
+        self._fs = FileSystem(basedir, hidden=(CAS_DIR,) if dedup else ())
+        self.basedir = self._fs.basedir()
+        self._chunkStore = ChunkStore(os.path.join(self.basedir, CAS_DIR)) if dedup else None
+    def trustHost(self, host: str, key: bytes) -> bool:
+        return self._transmissions.trusted().makeTrust(host, key)
     def isTrustedHost(self, host: str) -> bool:
-        return self._transmitter.isTrustedHost(host)
+        return self._transmissions.isTrustedHost(host)
     def prepare(self):
-        self._sock.listen(5)
-    def transmitter(self) -> Transmitter:
-        return self._transmitter
+        self._sock.listen(self._backlog)
+    def transmissions(self) -> TransmissionManager:
+        return self._transmissions
+    def fetchEngine(self) -> FetchEngine:
+        return self._fetchEngine
+    def fileSystem(self) -> FileSystem:
+        return self._fs
+    def verifyPool(self) -> ThreadPoolExecutor:
+        return self._verifyPool
+    def buffers(self) -> BufferPool:
+        return self._buffers
+    def metrics(self) -> metrics.Metrics:
+        return self._metrics
+    def chunkStore(self) -> Optional[ChunkStore]:
+        return self._chunkStore
     def serve(self, thread_join: bool = False) -> None:
         if thread_join:
             t = Thread(target=self.serve, name='ServerDaemon', daemon=True)
@@ -201,19 +677,66 @@ class Server:
     def stop(self):
         self._stopped = True
 
+class _TreeFile:
+    '''
+    A file of a fetched tree, received into a temporary file next to its
+    target and put in place once its checksum matches. Without a target the
+    data is only counted.
+    '''
+    def __init__(self, header: dict, target: Optional[str], check: str):
+        self.path = header['path']
+        self.size = header['size']
+        self.received = 0
+        self.dropped = target is None
+        self._mtime = header['mtime']
+        self._target = target
+        self._hasher = checksum.new(check)
+        self._fd = self._temp = None
+        if target:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            self._fd, self._temp = tempfile.mkstemp(dir=os.path.dirname(target))
+    def write(self, chunk: bytes) -> None:
+        self.received += len(chunk)
+        if self._fd is not None:
+            self._hasher.update(chunk)
+            os.write(self._fd, chunk)
+    def finish(self, digest: bytes) -> bool:
+        if self._fd is None:
+            return False
+        os.close(self._fd)
+        self._fd = None
+        if digest != self._hasher.digest():
+            os.unlink(self._temp)
+            return False
+        os.replace(self._temp, self._target)
+        if self._mtime is not None:
+            os.utime(self._target, (self._mtime, self._mtime))
+        return True
+    def discard(self) -> None:
+        self.dropped = True
+        if self._fd is not None:
+            os.close(self._fd)
+            os.unlink(self._temp)
+            self._fd = None
+
 class Client:
-    def __init__(self, host: str, port: int):
-        self._security = LocalSecurity.load('local.pem')
-        self._sock = StructuredSocket()
+    def __init__(self, host: str, port: int, security: Optional[LocalSecurity]=None):
+        self._security = security or LocalSecurity.load('local.pem')
+        self._sock = FrameSocket()
+        self._buffers = BufferPool()
         self._address = (host, port)
         self._authorized = False
         self._salt = None
+        self._transfer = None
+        self._pool = None # the ClientPool this came from, which parallel transfers borrow from too
     def _recv(self) -> bytes:
         return self._sock.recv()
     def _send(self, data: Union[bytes, dict]) -> None:
         if isinstance(data, dict):
             data = msgpack.packb(data)
         self._sock.send(data)
+    def _sendParts(self, *parts) -> None:
+        self._sock.sendParts(*parts)
     def address(self):
         return self._address
     def connect(self) -> None:
@@ -224,8 +747,18 @@ class Client:
             self._authorized = True
     def close(self) -> None:
         self._sock.close()
+    def alive(self) -> bool:
+        'Whether an idle connection is still usable; one the server closed turns readable.'
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
     def authorized(self) -> bool:
         return self._authorized
+    def lastTransfer(self) -> Optional[str]:
+        'The id of the last resumable upload, to be passed as resume= after a disconnect.'
+        return self._transfer
     def startRegister(self) -> Response:
         self._send({'type': 'register'})
         data = Response.unpack(self._recv())
@@ -247,45 +780,620 @@ class Client:
         self._send(data)
         data = Response.unpack(self._recv())
         return data
-    def upload(self, local: str, remote: str, chunk_callback: Optional[Callable[[int, int, bool], None]]=None) -> Response:
-        total = math.ceil(os.path.getsize(local) / CHUNK_SIZE)
-        self._send({ 'type': 'upload', 'dest': remote, 'total': total })
-        data = Response.unpack(self._recv())
-        if not data.success():
-            return data
-        stream = open(local, 'rb')
+    def stats(self) -> Response:
+        'Server metrics; the description packs {\'session\', \'server\'} snapshots.'
+        self._send({ 'type': 'stats' })
+        return Response.unpack(self._recv())
+    def _sendChunks(self, stream, total: int, chunk_callback: Optional[Callable[[int, int, bool], None]]) -> Response:
         count = 0
         while True:
             chunk = stream.read(CHUNK_SIZE)
             if not chunk:
                 break
             count += 1
-            self._security.chunk(chunk)
-            digest = md5(chunk).digest()
+            digest = self._security.chunk(chunk)
             while True:
-                self._send(chunk+digest)
+                self._sendParts(chunk, digest)
                 data = Response.unpack(self._recv())
                 if chunk_callback:
                     chunk_callback(count, total, data.error())
                 if data.success():
                     break
-        stream.close()
+        return Response.ok()
+    def _sendWindow(self, chunks: Iterator[bytes], total: int, window: int, offset: int, chunk_callback: Optional[Callable[[int, int, bool], None]], codec: Optional[str]=None, check: str=checksum.DEFAULT) -> Response:
+        inflight = {}
+        compressor = compression.Compressor(codec) if codec else None
+        for _ in range(offset): # the server already has these
+            self._security.chunk(next(chunks))
+        sent = acked = offset
+        outstanding = 0
+        while acked < total or outstanding:
+            while sent < total and sent < acked + window:
+                chunk = next(chunks)
+                digest = self._security.chunk(chunk, check)
+                packed = compressor and compressor.compress(chunk)
+                if packed is None:
+                    inflight[sent] = FRAME_HEADER.pack(sent, 0), chunk, digest
+                else:
+                    inflight[sent] = FRAME_HEADER.pack(sent, FLAG_COMPRESSED), packed, digest
+                self._sendParts(*inflight[sent])
+                sent += 1
+                outstanding += 1
+            data = Response.unpack(self._recv())
+            outstanding -= 1
+            info = msgpack.unpackb(data.description())
+            if data.code() == RespCode.RCE_INTEGRITY_FAIL:
+                self._sendParts(*inflight[info['resend']])
+                outstanding += 1
+            elif data.error():
+                return data
+            for seq in range(acked, info['ack']):
+                del inflight[seq]
+            acked = max(acked, info['ack'])
+            if chunk_callback:
+                chunk_callback(acked, total, data.error())
+        return Response.ok()
+    def _sendAdaptive(self, stream, size: int, window: int, offset: int, position: int, chunk_callback: Optional[Callable[[int, int, bool], None]], codec: Optional[str]=None, check: str=checksum.DEFAULT) -> Response:
+        # like _sendWindow, but every chunk is sized by the ChunkSizer and an
+        # end frame replaces the chunk count; progress is still reported in
+        # CHUNK_SIZE units
+        sizer = ChunkSizer(CHUNK_SIZE, MAX_CHUNK_SIZE, window)
+        compressor = compression.Compressor(codec) if codec else None
+        inflight = {}
+        stream.seek(0)
+        while stream.tell() < position: # the server already has these
+            self._security.update(stream.read(min(CHUNK_SIZE, position - stream.tell())))
+        total = math.ceil(size / CHUNK_SIZE)
+        # the server numbers chunks on from the offset chunks it already has
+        sent = acked = offset
+        outstanding = 0
+        end = None
+        while end is None or acked < end or outstanding:
+            while end is None and sent < acked + window:
+                # read into a pooled buffer, kept until the chunk is acked
+                buffer = self._buffers.acquire(sizer.size())
+                chunk = memoryview(buffer)[:stream.readinto(memoryview(buffer)[:sizer.size()])]
+                if not chunk:
+                    self._buffers.release(buffer)
+                    end = sent
+                    self._send(FRAME_HEADER.pack(end, FLAG_END) + checksum.digest(check, b''))
+                    outstanding += 1
+                    break
+                digest = self._security.chunk(chunk, check)
+                packed = compressor and compressor.compress(chunk)
+                if packed is None:
+                    frame = FRAME_HEADER.pack(sent, 0), chunk, digest
+                else:
+                    frame = FRAME_HEADER.pack(sent, FLAG_COMPRESSED), packed, digest
+                inflight[sent] = frame, len(chunk), buffer
+                sizer.sent(sent, len(chunk))
+                self._sendParts(*frame)
+                sent += 1
+                outstanding += 1
+            data = Response.unpack(self._recv())
+            outstanding -= 1
+            info = msgpack.unpackb(data.description())
+            if data.code() == RespCode.RCE_INTEGRITY_FAIL:
+                self._sendParts(*inflight[info['resend']][0])
+                outstanding += 1
+                sizer.retry()
+            elif data.error():
+                return data
+            for seq in range(acked, info['ack']):
+                _, length, buffer = inflight.pop(seq)
+                self._buffers.release(buffer)
+                position += length
+                sizer.acked(seq)
+            acked = max(acked, info['ack'])
+            if chunk_callback:
+                chunk_callback(math.ceil(position / CHUNK_SIZE), total, data.error())
+        return Response.ok()
+    def fileTree(self, path: Optional[List[str]], depth: int=1, meta: bool=True, limit: int=FSTREE_PAGE, cursor: Optional[int]=None, stream: bool=True) -> Iterator[Response]:
+        '''
+        Lists a remote directory up to depth levels, yielding one response per
+        page. Each page describes {'entries', 'cursor', 'base'}, an entry
+        being [relative path, is directory, size, mtime]. With stream set the
+        server sends every page at once; otherwise pass the returned cursor to
+        fetch the next one. A server without paging answers with one level,
+        in one page, without sizes and mtimes.
+        '''
+        data = { 'type': 'fstree', 'depth': depth, 'meta': meta, 'limit': limit, 'stream': stream }
+        if path: data['path'] = path
+        if cursor: data['cursor'] = cursor
+        self._send(data)
+        while True:
+            data = Response.unpack(self._recv())
+            if data.success():
+                page = msgpack.unpackb(data.description())
+                if 'entries' not in page: # {'files', 'dirs', 'base'}
+                    entries = [[[name], True, None, None] for name in page['dirs']] + [[[name], False, None, None] for name in page['files']]
+                    yield Response.ok(msgpack.packb({'entries': entries, 'cursor': None, 'base': page['base']}))
+                    return
+            yield data
+            if data.error() or not stream or msgpack.unpackb(data.description())['cursor'] is None:
+                return
+    @staticmethod
+    def _split(size: int, streams: int) -> List[List[int]]:
+        # chunk aligned [offset, length] ranges, one per stream
+        step = math.ceil(math.ceil(size / CHUNK_SIZE) / streams) * CHUNK_SIZE
+        return [[offset, min(step, size - offset)] for offset in range(0, size, step)]
+    @staticmethod
+    def _rangeChunks(local: str, offset: int, length: int) -> Iterator[bytes]:
+        with open(local, 'rb') as stream:
+            stream.seek(offset)
+            while length:
+                data = stream.read(min(CHUNK_SIZE, length))
+                if not data:
+                    raise IOError('%s changed during upload' % local)
+                length -= len(data)
+                yield data
+    @staticmethod
+    def _progress(ranges: List[List[int]], callback: Optional[Callable]) -> Callable[[int], Optional[Callable]]:
+        # merges the progress of the ranges into one callback
+        if not callback:
+            return lambda index: None
+        done = [0] * len(ranges)
+        total = sum(math.ceil(length / CHUNK_SIZE) for _, length in ranges)
+        lock = Lock()
+        def progress(index):
+            def report(count, _, *args):
+                with lock:
+                    done[index] = count
+                    callback(sum(done), total, *args)
+            return report
+        return progress
+    def _parallel(self, jobs: List[Callable[['Client'], Response]]) -> List[tuple]:
+        # runs every job on a connection of its own; returns (response, range digest) pairs
+        results = [None] * len(jobs)
+        def run(index):
+            worker = None
+            try:
+                if self._pool:
+                    worker = self._pool.acquire()
+                else:
+                    worker = Client(*self._address, self._security.fork())
+                    worker.connect()
+                if worker.authorized():
+                    results[index] = jobs[index](worker), worker._security.digest()
+                else:
+                    results[index] = Response(RespCode.RCE_UNAUTHORIZED), None
+                if self._pool and results[index][0].success():
+                    self._pool.release(worker)
+                    worker = None
+            except (PeerDisconnect, OSError) as e:
+                results[index] = Response.failed(str(e)), None
+            finally:
+                if worker:
+                    worker.close()
+        threads = [Thread(target=run, args=(i,), name='Transfer-%i' % i) for i in range(len(jobs))]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        return results
+    def _uploadRange(self, local: str, transfer_id: str, index: int, offset: int, length: int, window: int, compress: bool, chunk_callback: Optional[Callable[[int, int, bool], None]]) -> Response:
+        total = math.ceil(length / CHUNK_SIZE)
+        request = { 'type': 'upload_range', 'id': transfer_id, 'index': index, 'total': total, 'window': window or 1 }
+        if compress:
+            request['compress'] = compression.available()
+        request['check'] = checksum.available()
+        self._send(request)
+        data = Response.unpack(self._recv())
+        if not data.success():
+            return data
+        info = msgpack.unpackb(data.description())
+        self._security.reset()
+        return self._sendWindow(self._rangeChunks(local, offset, length), total, info['window'], 0, chunk_callback, info.get('compress'), info.get('check', checksum.DEFAULT))
+    def _parallelUpload(self, local: str, remote: str, streams: int, chunk_callback: Optional[Callable[[int, int, bool], None]], window: int, compress: bool) -> Response:
+        size = os.path.getsize(local)
+        ranges = self._split(size, streams)
+        self._send({ 'type': 'parallel_upload', 'dest': remote, 'size': size, 'ranges': ranges })
+        data = Response.unpack(self._recv())
+        if not data.success():
+            return data
+        transfer_id = msgpack.unpackb(data.description())['id']
+        progress = self._progress(ranges, chunk_callback)
+        results = self._parallel([
+            lambda worker, i=i, r=r: worker._uploadRange(local, transfer_id, i, r[0], r[1], window, compress, progress(i))
+            for i, r in enumerate(ranges)
+        ])
+        failed = next((resp for resp, _ in results if resp.error()), None)
+        if failed:
+            self._send(b'') # makes the server drop the transfer
+            self._recv()
+            return failed
+        root = SHA384.new(b''.join(digest for _, digest in results))
+        self._send(self._security.sign(root))
+        return Response.unpack(self._recv())
+    def _deltaUpload(self, local: str, remote: str, chunk_callback: Optional[Callable[[int, int, bool], None]]) -> Response:
+        size = os.path.getsize(local)
+        self._send({ 'type': 'delta_upload', 'dest': remote })
+        data = Response.unpack(self._recv())
+        if not data.success():
+            return data
+        info = msgpack.unpackb(data.description())
+        block = info['block']
+        pages = [self._recv() for _ in range(math.ceil(info['count'] / DELTA_PAGE))]
+        self._security.reset()
+        total, done = math.ceil(size / CHUNK_SIZE), 0
+        with open(local, 'rb') as stream:
+            for op, start, end, first in delta.Matcher(block, pages).match(local, size):
+                if op == 'blocks':
+                    self._send(DELTA_BLOCKS + DELTA_RUN.pack(first, math.ceil((end - start) / block)))
+                done += end - start
+                stream.seek(start)
+                while start < end:
+                    chunk = stream.read(min(CHUNK_SIZE, end - start))
+                    if not chunk:
+                        raise IOError('%s changed during upload' % local)
+                    self._security.update(chunk)
+                    if op == 'literal':
+                        self._send(DELTA_LITERAL + chunk)
+                    start += len(chunk)
+                if chunk_callback:
+                    chunk_callback(math.ceil(done / CHUNK_SIZE), total, False)
+        self._send(DELTA_END)
+        self._send(self._security.finish())
+        return Response.unpack(self._recv())
+    def _dedupUpload(self, local: str, remote: str, chunk_callback: Optional[Callable[[int, int, bool], None]]) -> Response:
+        self._security.reset()
+        keys = cas.chunk_keys(local, self._security.update)
+        self._send({ 'type': 'cas_upload', 'dest': remote, 'keys': keys })
+        data = Response.unpack(self._recv())
+        if not data.success():
+            return data
+        missing = msgpack.unpackb(data.description())['missing']
+        with open(local, 'rb') as stream:
+            for sent, index in enumerate(missing, 1):
+                stream.seek(index * cas.CHUNK_SIZE)
+                self._send(stream.read(cas.CHUNK_SIZE))
+                if chunk_callback:
+                    chunk_callback(sent, len(missing), False)
+        self._send(self._security.finish())
+        return Response.unpack(self._recv())
+    def upload(self, local: str, remote: str, chunk_callback: Optional[Callable[[int, int, bool], None]]=None, window: int=DEFAULT_WINDOW, resume: Optional[str]=None, compress: bool=False, streams: int=1, delta: bool=False, dedup: bool=False) -> Response:
+        '''
+        With delta set, only the parts of the file the server's version at
+        remote lacks are sent; servers without delta support get the whole file.
+        With dedup set, only the chunks missing from the server's chunk store
+        are sent, for servers started with one.
+        '''
+        if dedup:
+            data = self._dedupUpload(local, remote, chunk_callback)
+            if data.code() != RespCode.RCE_NO_SUCH_COMMAND:
+                return data
+        if delta:
+            data = self._deltaUpload(local, remote, chunk_callback)
+            if data.code() != RespCode.RCE_NO_SUCH_COMMAND:
+                return data
+        if streams > 1 and os.path.getsize(local) >= PARALLEL_MIN_SIZE:
+            return self._parallelUpload(local, remote, streams, chunk_callback, window, compress)
+        size = os.path.getsize(local)
+        total = math.ceil(size / CHUNK_SIZE)
+        request = { 'type': 'upload', 'dest': remote, 'total': total, 'size': size }
+        if window:
+            request['window'] = window
+            if resume:
+                request['resume'] = resume
+            if compress:
+                request['compress'] = compression.available()
+            request['check'] = checksum.available()
+            request['adaptive'] = True
+        self._send(request)
+        data = Response.unpack(self._recv())
+        if not data.success():
+            return data
+        self._security.reset()
+        stream = open(local, 'rb')
+        try:
+            if data.description():
+                info = msgpack.unpackb(data.description())
+                self._transfer = info.get('id')
+                if info.get('adaptive'):
+                    data = self._sendAdaptive(stream, os.path.getsize(local), info['window'], info['offset'], info['position'], chunk_callback, info.get('compress'), info.get('check', checksum.DEFAULT))
+                else: # servers without adaptive chunks
+                    chunks = iter(lambda: stream.read(CHUNK_SIZE), b'')
+                    data = self._sendWindow(chunks, total, info['window'], info.get('offset', 0), chunk_callback, info.get('compress'), info.get('check', checksum.DEFAULT))
+            else: # stop-and-wait, also what servers without window support answer
+                data = self._sendChunks(stream, total, chunk_callback)
+        finally:
+            stream.close()
+        if data.error():
+            return data
         signature = self._security.finish()
         self._send(signature)
         data = Response.unpack(self._recv())
         return data
-    def fetch(self, local: str, remote: str, chunk_callback: Optional[Callable[[int, int], None]]=None) -> Response:
+    @staticmethod
+    def _manifest(locals: List[str]) -> tuple:
+        # files and directories to send, with paths relative to the target;
+        # directories are sent with everything below them
+        manifest, sources = [], []
+        for local in locals:
+            name = os.path.basename(os.path.normpath(local))
+            if not os.path.isdir(local):
+                manifest.append([[name], os.path.getsize(local)])
+                sources.append(local)
+                continue
+            for root, dirnames, filenames in os.walk(local):
+                parts = [name] + os.path.relpath(root, local).split(os.sep)
+                parts = [p for p in parts if p != os.curdir]
+                if not filenames and not dirnames:
+                    manifest.append([parts, None])
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    manifest.append([parts + [filename], os.path.getsize(path)])
+                    sources.append(path)
+        return manifest, sources
+    @staticmethod
+    def _packChunks(sources: List[str], sizes: List[int]) -> Iterator[bytes]:
+        # the files back to back, cut into chunks regardless of file boundaries
+        buffer = bytearray()
+        for source, size in zip(sources, sizes):
+            with open(source, 'rb') as stream:
+                while size:
+                    data = stream.read(min(CHUNK_SIZE - len(buffer), size))
+                    if not data:
+                        raise IOError('%s changed during upload' % source)
+                    buffer += data
+                    size -= len(data)
+                    if len(buffer) == CHUNK_SIZE:
+                        yield bytes(buffer)
+                        buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+    def batchUpload(self, locals: List[str], remote: List[str], chunk_callback: Optional[Callable[[int, int, bool], None]]=None, window: int=DEFAULT_WINDOW, compress: bool=False) -> Response:
+        manifest, sources = self._manifest(locals)
+        sizes = [size for _, size in manifest if size is not None]
+        total = math.ceil(sum(sizes) / CHUNK_SIZE)
+        packed = msgpack.packb(manifest)
+        request = { 'type': 'batch_upload', 'dest': remote, 'manifest': packed, 'total': total, 'window': window or 1 }
+        if compress:
+            request['compress'] = compression.available()
+        request['check'] = checksum.available()
+        self._send(request)
+        data = Response.unpack(self._recv())
+        if data.code() == RespCode.RCE_NO_SUCH_COMMAND and not any(os.path.isdir(local) for local in locals):
+            return self._uploadEach(sources, sizes, remote, chunk_callback, window, compress)
+        if not data.success():
+            return data
+        self._security.reset()
+        self._security.chunk(packed)
+        info = msgpack.unpackb(data.description())
+        data = self._sendWindow(self._packChunks(sources, sizes), total, info['window'], 0, chunk_callback, info.get('compress'), info.get('check', checksum.DEFAULT))
+        if data.error():
+            return data
+        self._send(self._security.finish())
+        return Response.unpack(self._recv())
+    def _uploadEach(self, sources: List[str], sizes: List[int], remote: List[str], chunk_callback: Optional[Callable[[int, int, bool], None]], window: int, compress: bool) -> Response:
+        # batch_upload for servers without it: plain files one by one, with
+        # the progress counted over all of them
+        done, total = 0, sum(math.ceil(size / CHUNK_SIZE) for size in sizes)
+        callback = chunk_callback and (lambda count, _, retrying: chunk_callback(done + count, total, retrying))
+        data = Response(RespCode.RCS_OK)
+        for source, size in zip(sources, sizes):
+            data = self.upload(source, remote + [os.path.basename(source)], callback, window, compress=compress)
+            if data.error():
+                return data
+            done += math.ceil(size / CHUNK_SIZE)
+        return data
+    def _recvChunk(self, codec: Optional[str]) -> Tuple[memoryview, bytearray]:
+        'The next chunk and the pooled buffer holding it, to be released once the chunk is written.'
+        frame, buffer = self._sock.recvInto(self._buffers)
+        return self._decodeChunk(frame, codec), buffer
+    @staticmethod
+    def _decodeChunk(chunk: bytes, codec: Optional[str]) -> bytes:
+        if codec:
+            flags, chunk = chunk[0], chunk[1:]
+            if flags & FLAG_COMPRESSED:
+                chunk = compression.decompress(codec, chunk, MAX_CHUNK_SIZE)
+        return chunk
+    def _fetchRange(self, part: str, remote: List[str], transfer_id: str, offset: int, length: int, compress: bool, chunk_callback: Optional[Callable[[int, int], None]]) -> Response:
+        request = { 'type': 'fetch', 'path': remote, 'offset': offset, 'length': length, 'resume': transfer_id }
+        if compress:
+            request['compress'] = compression.available()
+        request['check'] = checksum.available()
+        self._send(request)
+        data = Response.unpack(self._recv())
+        if data.error():
+            return data
+        info = msgpack.unpackb(data.description())
+        hasher = checksum.new(info.get('check', checksum.DEFAULT))
+        fd = os.open(part, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            for i in range(info['total']):
+                chunk, buffer = self._recvChunk(info.get('compress'))
+                hasher.update(chunk)
+                pwrite(fd, chunk, offset)
+                offset += len(chunk)
+                self._buffers.release(buffer)
+                if chunk_callback:
+                    chunk_callback(i+1, info['total'])
+        finally:
+            os.close(fd)
+        if self._recv() != hasher.digest():
+            return Response(RespCode.RCE_INTEGRITY_FAIL)
+        return Response.ok()
+    def _parallelFetch(self, local: str, remote: List[str], streams: int, chunk_callback: Optional[Callable[[int, int], None]], resumable: bool, compress: bool) -> Response:
+        self._send({ 'type': 'stat', 'path': remote })
+        data = Response.unpack(self._recv())
+        if data.error():
+            return data
+        info = msgpack.unpackb(data.description())
+        if info['size'] < PARALLEL_MIN_SIZE:
+            return self.fetch(local, remote, chunk_callback, resumable, compress)
+        part = local + '.part'
+        with open(part, 'wb') as stream:
+            stream.truncate(info['size'])
+        ranges = self._split(info['size'], streams)
+        progress = self._progress(ranges, chunk_callback)
+        results = self._parallel([
+            lambda worker, i=i, r=r: worker._fetchRange(part, remote, info['id'], r[0], r[1], compress, progress(i))
+            for i, r in enumerate(ranges)
+        ])
+        failed = next((resp for resp, _ in results if resp.error()), None)
+        if failed:
+            os.unlink(part)
+            return failed
+        os.replace(part, local)
+        return Response.ok()
+    def fetch(self, local: str, remote: str, chunk_callback: Optional[Callable[[int, int], None]]=None, resumable: bool=True, compress: bool=False, streams: int=1) -> Response:
+        if streams > 1:
+            return self._parallelFetch(local, remote, streams, chunk_callback, resumable, compress)
+        if not resumable:
+            return self._fetchOnce(local, remote, chunk_callback)
+        # partial data and the server's transfer id are kept next to the
+        # destination until the fetch completes
+        part, journal = local + '.part', local + '.part.json'
+        resume, offset = None, 0
+        try:
+            state = json.load(open(journal))
+            if state['remote'] == remote:
+                resume, offset = state['id'], os.path.getsize(part)
+        except (OSError, ValueError, KeyError):
+            pass
+        request = { 'type': 'fetch', 'path': remote, 'offset': offset, 'resume': resume, 'adaptive': True }
+        if compress:
+            request['compress'] = compression.available()
+        request['check'] = checksum.available()
+        self._send(request)
+        data = Response.unpack(self._recv())
+        if data.error():
+            return data
+        if isinstance(data.description(), str): # server without resume support
+            return self._receiveFile(local, int(data.description()), chunk_callback)
+        info = msgpack.unpackb(data.description())
+        with open(journal, 'w') as f:
+            json.dump({'remote': remote, 'id': info['id']}, f)
+        hasher = checksum.new(info.get('check', checksum.DEFAULT))
+        with open(part, 'r+b' if info['offset'] else 'wb') as stream:
+            stream.truncate(info['offset'])
+            while stream.tell() < info['offset']:
+                hasher.update(stream.read(min(CHUNK_SIZE, info['offset'] - stream.tell())))
+            if info.get('adaptive'):
+                # progress in CHUNK_SIZE units, whatever size the chunks are
+                position, total = info['offset'], math.ceil(info['size'] / CHUNK_SIZE)
+                while True:
+                    frame, buffer = self._sock.recvInto(self._buffers)
+                    if not frame: # end of the data
+                        self._buffers.release(buffer)
+                        break
+                    chunk = self._decodeChunk(frame, info.get('compress'))
+                    hasher.update(chunk)
+                    stream.write(chunk)
+                    position += len(chunk)
+                    self._buffers.release(buffer)
+                    if chunk_callback:
+                        chunk_callback(math.ceil(position / CHUNK_SIZE), total)
+            else:
+                done = info['offset'] // CHUNK_SIZE
+                total = done + info['total']
+                for i in range(info['total']):
+                    chunk, buffer = self._recvChunk(info.get('compress'))
+                    hasher.update(chunk)
+                    stream.write(chunk)
+                    self._buffers.release(buffer)
+                    if chunk_callback:
+                        chunk_callback(done+i+1, total)
+        digest = self._recv()
+        os.unlink(journal)
+        if digest != hasher.digest():
+            os.unlink(part)
+            return Response(RespCode.RCE_INTEGRITY_FAIL)
+        os.replace(part, local)
+        return Response.ok()
+    @staticmethod
+    def _treePath(local: str, parts: List[str]) -> Optional[str]:
+        # names come from the server and must not lead out of local
+        if not parts:
+            return None
+        for part in parts:
+            if part in ('', os.curdir, os.pardir) or os.sep in part or (os.altsep and os.altsep in part) or os.path.splitdrive(part)[0]:
+                return None
+        return os.path.join(local, *parts)
+    def fetchTree(self, local: str, remote: Optional[List[str]], chunk_callback: Optional[Callable[[int, int], None]]=None, compress: bool=False) -> Response:
+        '''
+        Fetches the remote directory into local as one stream, unpacking it
+        as it arrives; chunk_callback gets the progress of the current file.
+        Entries that cannot be read on the server or written here are
+        skipped; the response describes {'files', 'errors'}, errors being
+        [path, reason] pairs.
+        '''
+        request = { 'type': 'fetch_tree', 'path': remote, 'check': checksum.available() }
+        if compress:
+            request['compress'] = compression.available()
+        self._send(request)
+        data = Response.unpack(self._recv())
+        if data.error():
+            return data
+        info = msgpack.unpackb(data.description())
+        codec, check = info.get('compress'), info.get('check', checksum.DEFAULT)
+        os.makedirs(local, exist_ok=True)
+        files, errors = 0, []
+        current = None
+        try:
+            while True:
+                frame, buffer = self._sock.recvInto(self._buffers)
+                kind = bytes(frame[:1])
+                if kind == TREE_DATA:
+                    try:
+                        current.write(self._decodeChunk(frame[1:], codec))
+                    except OSError as e:
+                        errors.append([current.path, e.strerror or str(e)])
+                        current.discard() # the rest of the file is dropped
+                    finally:
+                        self._buffers.release(buffer)
+                    if chunk_callback and current.size:
+                        chunk_callback(current.received, current.size)
+                    continue
+                record = bytes(frame[1:])
+                self._buffers.release(buffer)
+                if kind == TREE_ENTRY:
+                    header = msgpack.unpackb(record)
+                    target = self._treePath(local, header['path'])
+                    if target is None:
+                        errors.append([header['path'], 'invalid path'])
+                    try:
+                        if header['dir']:
+                            if target: os.makedirs(target, exist_ok=True)
+                        else:
+                            current = _TreeFile(header, target, check)
+                    except OSError as e:
+                        errors.append([header['path'], e.strerror or str(e)])
+                        if not header['dir']:
+                            current = _TreeFile(header, None, check)
+                elif kind == TREE_FILE_END:
+                    if current.finish(record):
+                        files += 1
+                    elif not current.dropped:
+                        errors.append([current.path, 'checksum mismatch'])
+                    current = None
+                elif kind == TREE_ERROR:
+                    failure = msgpack.unpackb(record)
+                    if current and current.path == failure['path']:
+                        current.discard()
+                        current = None
+                    errors.append([failure['path'], failure['error']])
+                elif kind == TREE_END:
+                    break
+                else:
+                    raise IOError('bad tree record')
+        finally:
+            if current:
+                current.discard()
+        return Response.ok(msgpack.packb({'files': files, 'errors': errors}))
+    def _fetchOnce(self, local: str, remote: str, chunk_callback: Optional[Callable[[int, int], None]]=None) -> Response:
         self._send({ 'type': 'fetch', 'path': remote })
         data = Response.unpack(self._recv())
         if data.error():
             return data
-        total = int(data.description())
+        return self._receiveFile(local, int(data.description()), chunk_callback)
+    def _receiveFile(self, local: str, total: int, chunk_callback: Optional[Callable[[int, int], None]]=None) -> Response:
         hasher = md5()
         fd, temp = tempfile.mkstemp()
         for i in range(total):
-            chunk = self._recv()
+            chunk, buffer = self._sock.recvInto(self._buffers)
             hasher.update(chunk)
             os.write(fd, chunk)
+            self._buffers.release(buffer)
             if chunk_callback:
                 chunk_callback(i+1, total)
         os.close(fd)
@@ -295,4 +1403,63 @@ class Client:
             return Response(RespCode.RCE_INTEGRITY_FAIL)
         else:
             shutil.move(temp, local)
-            return Response.ok()
\ No newline at end of file
+            return Response.ok()
+
+class ClientPool:
+    '''
+    Connections to one server kept open between uses, so that browsing and
+    several transfers can run at once without paying the handshake and the
+    server's trust lookup for each. A connection serves one thread at a
+    time: take one with acquire() and give it back with release(), or use
+    the client() context manager. Up to size idle connections are kept, for
+    at most idle seconds each.
+    '''
+    def __init__(self, host: str, port: int, security: Optional[LocalSecurity]=None, size: int=4, idle: float=300.0):
+        self._address = (host, port)
+        self._security = security or LocalSecurity.load('local.pem')
+        self._size = size
+        self._maxIdle = idle
+        self._idle = deque() # (client, released at), most recent last
+        self._lock = Lock()
+    def acquire(self) -> Client:
+        'An idle connection that is still alive, or a new one.'
+        stale = []
+        client = None
+        with self._lock:
+            while self._idle and client is None:
+                client, since = self._idle.pop()
+                if monotonic() - since > self._maxIdle or not client.alive():
+                    stale.append(client)
+                    client = None
+        for old in stale:
+            old.close()
+        if client is None:
+            client = Client(*self._address, self._security.fork())
+            client._pool = self
+            client.connect()
+        return client
+    def release(self, client: Client) -> None:
+        'Returns a connection after a complete exchange; anything else should close it instead.'
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append((client, monotonic()))
+                return
+        client.close()
+    @contextmanager
+    def client(self) -> Iterator[Client]:
+        client = self.acquire()
+        try:
+            yield client
+        except BaseException:
+            client.close() # the exchange may have stopped halfway
+            raise
+        self.release(client)
+    def idle(self) -> int:
+        return len(self._idle)
+    def clear(self) -> None:
+        'Closes the idle connections, e.g. after registering, so that new ones are authorized.'
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for client, _ in idle:
+            client.close()
+    close = clear
\ No newline at end of file
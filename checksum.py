@@ -0,0 +1,62 @@
+import zlib
+from hashlib import md5
+from typing import Callable, Dict, List
+
+class _CRC32:
+    def __init__(self, data: bytes=b''):
+        self._value = zlib.crc32(data)
+    def update(self, data: bytes) -> None:
+        self._value = zlib.crc32(data, self._value)
+    def digest(self) -> bytes:
+        return self._value.to_bytes(4, 'big')
+
+# name -> hasher factory; every hasher has update() and digest()
+ALGORITHMS: Dict[str, Callable] = {'md5': md5, 'crc32': _CRC32}
+
+try:
+    import xxhash
+except ImportError:
+    pass
+else:
+    ALGORITHMS['xxh64'] = xxhash.xxh64
+
+try:
+    import crc32c
+except ImportError:
+    pass
+else:
+    class _CRC32C:
+        def __init__(self, data: bytes=b''):
+            self._value = crc32c.crc32c(data)
+        def update(self, data: bytes) -> None:
+            self._value = crc32c.crc32c(data, self._value)
+        def digest(self) -> bytes:
+            return self._value.to_bytes(4, 'big')
+    ALGORITHMS['crc32c'] = _CRC32C
+
+# fastest first; md5 is what peers without negotiation use
+PREFERENCE = ['xxh64', 'crc32c', 'crc32', 'md5']
+DEFAULT = 'md5'
+SIZES = {name: len(factory(b'').digest()) for name, factory in ALGORITHMS.items()}
+
+def available() -> List[str]:
+    'The checksums usable here, fastest first.'
+    return [name for name in PREFERENCE if name in ALGORITHMS]
+
+def negotiate(requested) -> str:
+    'Picks the first checksum of the peer\'s preference list supported here.'
+    if isinstance(requested, str):
+        requested = [requested]
+    for name in requested or ():
+        if name in ALGORITHMS:
+            return name
+    return DEFAULT
+
+def new(name: str, data: bytes=b''):
+    return ALGORITHMS[name](data)
+
+def digest(name: str, data: bytes) -> bytes:
+    return ALGORITHMS[name](data).digest()
+
+def size(name: str) -> int:
+    return SIZES[name]
\ No newline at end of file
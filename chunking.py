@@ -0,0 +1,72 @@
+import time
+from typing import Dict, Optional
+
+MIN_CHUNK_SIZE = 64*1024
+# sending one chunk should take about this long at the measured throughput,
+# so that the per-frame cost (header, checksum, ack, syscalls) is amortised
+TARGET_CHUNK_TIME = 0.05
+# chunk sizes are kept to whole pages
+ALIGN = 4096
+
+class ChunkSizer:
+    '''
+    Picks the size of the next chunk of a transfer from what the transfer
+    measured so far. A chunk should take about TARGET_CHUNK_TIME to send at
+    the measured throughput, and a window of chunks should cover the
+    bandwidth-delay product. Every integrity retry halves the size so that a
+    lossy link resends less; a window of clean acks lets it grow back.
+    '''
+    def __init__(self, initial: int, maximum: int, window: int=1, minimum: int=MIN_CHUNK_SIZE):
+        self._size = initial
+        self._min = minimum
+        self._max = maximum
+        self._window = window
+        self._cap = maximum
+        self._clean = 0
+        self._inflight: Dict[int, tuple] = {}
+        self._rtt: Optional[float] = None
+        self._rate: Optional[float] = None
+        self._mark = time.perf_counter()
+        self._bytes = 0
+    def size(self) -> int:
+        return self._size
+    def rtt(self) -> Optional[float]:
+        return self._rtt
+    def rate(self) -> Optional[float]:
+        return self._rate
+    def sent(self, seq: int, length: int) -> None:
+        self._inflight[seq] = time.perf_counter(), length
+    def acked(self, seq: int) -> None:
+        'The peer has chunk seq; samples the round trip and the throughput.'
+        entry = self._inflight.pop(seq, None)
+        if entry is None:
+            return
+        sample = time.perf_counter() - entry[0]
+        self._rtt = sample if self._rtt is None else 0.875 * self._rtt + 0.125 * sample
+        self._clean += 1
+        if self._clean >= self._window:
+            self._clean = 0
+            self._cap = min(self._max, self._cap * 2)
+        self.transferred(entry[1])
+    def transferred(self, length: int) -> None:
+        'Counts bytes that left (or were acknowledged) just now.'
+        self._bytes += length
+        now = time.perf_counter()
+        elapsed = now - self._mark
+        if elapsed >= max(self._rtt or 0, 0.01):
+            sample = self._bytes / elapsed
+            self._rate = sample if self._rate is None else 0.75 * self._rate + 0.25 * sample
+            self._mark, self._bytes = now, 0
+        self._update()
+    def retry(self) -> None:
+        self._clean = 0
+        self._cap = max(self._min, self._size // 2)
+        self._update()
+    def _update(self) -> None:
+        size = self._size
+        if self._rate:
+            size = self._rate * TARGET_CHUNK_TIME
+            if self._rtt:
+                size = max(size, self._rate * self._rtt / self._window)
+        size = min(size, self._cap)
+        self._size = int(max(self._min, min(self._max, size))) // ALIGN * ALIGN
\ No newline at end of file
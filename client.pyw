@@ -2,7 +2,7 @@ import sys
 from PyQt5 import QtCore, QtGui, QtWidgets
 import os, msgpack, winreg
 from security import KeyExport, LocalSecurity
-from channels import Client
+from channels import Client, ClientPool
 from response import RespCode
 
 TITLE = 'Verified Transmit'
@@ -18,7 +18,9 @@ code_map = {
     RespCode.RCE_WRONG_PASSWORD: '提供的密码与服务器生成的不符。',
     RespCode.RCE_INVALID_FSPATH: '无效的文件系统路径请求。',
     RespCode.RCE_NO_SUCH_COMMAND: '请求的操作在服务器上未被定义，或已被禁用。',
-    RespCode.RCE_ACCESS_DENIED: '对目标项的访问被拒绝。这可能是启动服务器的用户不具有访问该目录的权限。'
+    RespCode.RCE_ACCESS_DENIED: '对目标项的访问被拒绝。这可能是启动服务器的用户不具有访问该目录的权限。',
+    RespCode.RCE_TRANSMITTER_OCCUPIED: '服务器上的传输数量已达上限，请稍后重试。',
+    RespCode.RCE_TRANSFER_UNKNOWN: '传输不存在或已失效，服务器上的文件可能已被修改。'
 }
 
 desktop = None
@@ -61,6 +63,7 @@ class Ui_MainWindow(object):
     def __init__(self):
         self._hasLocalPEM = os.path.isfile('local.pem')
         self._client = None
+        self._pool = None # connections for transfers, so browsing goes on meanwhile
         self._dir = []
         self.FILE_ICON = QtGui.QIcon('file-icon.png')
         self.FOLDER_ICON = QtGui.QIcon('folder-icon.png')
@@ -143,6 +146,8 @@ class Ui_MainWindow(object):
         self.actionRemove.setObjectName("actionRemove")
         self.actionClear = QtWidgets.QAction(MainWindow)
         self.actionClear.setObjectName("actionClear")
+        self.actionFetchDir = QtWidgets.QAction(MainWindow)
+        self.actionFetchDir.setObjectName("actionFetchDir")
         self.actionExit = QtWidgets.QAction(MainWindow)
         self.actionExit.setObjectName("actionExit")
         self.actionGenerate = QtWidgets.QAction(MainWindow)
@@ -159,6 +164,8 @@ class Ui_MainWindow(object):
         self.menuFile.addAction(self.actionRemove)
         self.menuFile.addAction(self.actionClear)
         self.menuFile.addSeparator()
+        self.menuFile.addAction(self.actionFetchDir)
+        self.menuFile.addSeparator()
         self.menuFile.addAction(self.actionExit)
         self.menuSecurity.addAction(self.actionGenerate)
         self.menuSecurity.addAction(self.actionRegister)
@@ -177,6 +184,7 @@ class Ui_MainWindow(object):
         self.actionSelect.setEnabled(False)
         self.actionRemove.setEnabled(False)
         self.actionClear.setEnabled(False)
+        self.actionFetchDir.setEnabled(False)
         self.actionGenerate.setEnabled(not self._hasLocalPEM)
         self.actionKeyInfo.setEnabled(self._hasLocalPEM)
         self.actionConnectionInfo.setEnabled(False)
@@ -187,6 +195,7 @@ class Ui_MainWindow(object):
         self.actionConnect.triggered.connect(self.connectionDialog)
         self.actionConnectionInfo.triggered.connect(self.connectionInfo)
         self.targetTree.itemDoubleClicked.connect(self.switchDir)
+        self.actionFetchDir.triggered.connect(self.fetchFolder)
         self.actionRegister.triggered.connect(self.registerKey)
         self.fileList.setSelectionMode(QtWidgets.QAbstractItemView.MultiSelection)
         self.fileList.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
@@ -215,7 +224,7 @@ class Ui_MainWindow(object):
             todo.append(self.waiting[index][0])
         targetdir = os.path.sep.join(self._dir)
         self.centralwidget.setEnabled(False)
-        self.ud = ud = UploadDialog(self._client, todo, self._dir, self.win)
+        self.ud = ud = UploadDialog(self._pool, todo, self._dir, self.win)
         ud.show()
         ud.accepted.connect(self.uploadFinished)
     def uploadFinished(self):
@@ -301,19 +310,31 @@ class Ui_MainWindow(object):
         if resp.success():
             QtWidgets.QMessageBox.information(self.win, TITLE, '密钥注册成功。\n\n此计算机已成为受信任的来源。')
             self.actionRegister.setEnabled(False)
+            self._pool.clear() # connected before the key was trusted
         else:
             QtWidgets.QMessageBox.critical(self.win, TITLE, '密钥注册失败。\n\n原因：\n%s' % format_code(resp.code()))
     def keyInfo(self):
         export = KeyExport.load('local.pem')
-        msg = 'RSA 密钥信息:\n\n'
-        msg += 'RSA 指数: %i\n'
-        msg += 'RSA 模数: %s\n'
-        msg += '密钥 SHA-256 摘要标识符: %s\n'
-        msg += '公钥 SHA-256 摘要标识符: %s'
-        msg = msg % (export.key().e, wrap(str(export.key().n)), export.identifier(), export.publicKey().identifier())
+        if export.isRSA():
+            msg = 'RSA 密钥信息:\n\n'
+            msg += 'RSA 指数: %i\n' % export.key().e
+            msg += 'RSA 模数: %s\n' % wrap(str(export.key().n))
+        else:
+            msg = 'Ed25519 密钥信息:\n\n'
+            msg += 'Ed25519 公钥: %s\n' % wrap(export.key().public_key().export_key(format='raw').hex())
+        msg += '密钥 SHA-256 摘要标识符: %s\n' % export.identifier()
+        msg += '公钥 SHA-256 摘要标识符: %s' % export.publicKey().identifier()
         QtWidgets.QMessageBox.information(self.win, TITLE, msg)
     def generateKey(self):
-        LocalSecurity.generate().save('local.pem')
+        kinds = [
+            ('RSA 1024（签名最快，兼容所有服务器）', 'rsa', 1024),
+            ('RSA 3072（更安全，签名约慢十倍，兼容所有服务器）', 'rsa', 3072),
+            ('Ed25519（安全，签名快于 RSA 3072，需要新版服务器）', 'ed25519', 0),
+        ]
+        kind, ok = QtWidgets.QInputDialog.getItem(self.win, TITLE, '密钥类型：', [k[0] for k in kinds], 0, False)
+        if not ok: return
+        _, kind, bits = next(k for k in kinds if k[0] == kind)
+        LocalSecurity.generate(kind, bits).save('local.pem')
         QtWidgets.QMessageBox.information(self.win, TITLE, '已生成本地密钥文件。')
         self._hasLocalPEM = True
         self.actionGenerate.setEnabled(False)
@@ -325,6 +346,7 @@ class Ui_MainWindow(object):
     def connected(self):
         self.actionConnect.setEnabled(False)
         self._client = self._cd.getClient()
+        self._pool = ClientPool(*self._client.address(), size=2)
         self.centralwidget.setEnabled(True)
         if not self._client.authorized():
             QtWidgets.QMessageBox.warning(self.win, TITLE, '本计算机还未进行公钥注册，无法上传文件。\n请前往菜单"安全 > 公钥认证"进行认证。')
@@ -333,6 +355,7 @@ class Ui_MainWindow(object):
         self.buttonClear.setEnabled(False)
         self.buttonUpload.setEnabled(False)
         self.actionConnectionInfo.setEnabled(True)
+        self.actionFetchDir.setEnabled(True)
         self.actionRegister.setEnabled(not self._client.authorized())
         self.updateFileSystem()
     def connectionInfo(self):
@@ -350,22 +373,29 @@ class Ui_MainWindow(object):
             self._dir.pop()
         elif path:
             self._dir.append(path)
-        resp = self._client.fileSystem(self._dir)
-        if resp.error():
-            self._dir = cache
-            QtWidgets.QMessageBox.critical(self.win, TITLE, '切换目录失败。\n\n原因:\n%s' % format_code(resp.code()))
-            return
-        data = msgpack.unpackb(resp.description())
-        self.files = data['files']
-        self.dirs = data['dirs']
-        root = data['base']
+        files, dirs, sizes = [], [], {}
+        for resp in self._client.fileTree(self._dir):
+            if resp.error():
+                self._dir = cache
+                QtWidgets.QMessageBox.critical(self.win, TITLE, '切换目录失败。\n\n原因:\n%s' % format_code(resp.code()))
+                return
+            data = msgpack.unpackb(resp.description())
+            for path, isdir, size, mtime in data['entries']:
+                (dirs if isdir else files).append(path[-1])
+                sizes[path[-1]] = size
+            root = data['base']
+        self.files = files
+        self.dirs = dirs
         self.targetTree.clear()
         if not root:
             self.targetTree.addItem(QtWidgets.QListWidgetItem(self.FOLDER_ICON, '..'))
         for d in self.dirs:
             self.targetTree.addItem(QtWidgets.QListWidgetItem(self.FOLDER_ICON, d))
         for f in self.files:
-            self.targetTree.addItem(QtWidgets.QListWidgetItem(self.FILE_ICON, f))
+            item = QtWidgets.QListWidgetItem(self.FILE_ICON, f)
+            if sizes[f] is not None: # older servers send no sizes
+                item.setToolTip(format_size(sizes[f]))
+            self.targetTree.addItem(item)
     def switchDir(self):
         item = self.targetTree.selectedItems()[0].text()
         if item in self.dirs or item == '..':
@@ -381,7 +411,21 @@ class Ui_MainWindow(object):
         extname = ext[1:].upper()
         path = QtWidgets.QFileDialog.getSaveFileName(self.win, '下载文件', get_desktop(), '%s 文件 (*%s)' % (extname, ext))[0]
         if not path: return
-        self.fthread = DownloadThread(self._client, path, item)
+        self.fthread = DownloadThread(self._pool, path, item)
+        self.fthread.callback.connect(self.fetchProgress)
+        self.fthread.finished.connect(self.fetchFinished)
+        self.fthread.start()
+    def fetchFolder(self):
+        if self.fthread:
+            QtWidgets.QMessageBox.information(self.win, TITLE, '请等待当前文件下载完成。')
+            return
+        # the selected folder, or the current one
+        selected = [item.text() for item in self.targetTree.selectedItems() if item.text() in self.dirs]
+        remote = self._dir + selected[:1]
+        path = QtWidgets.QFileDialog.getExistingDirectory(self.win, '下载文件夹', get_desktop())
+        if not path: return
+        local = os.path.join(path, remote[-1] if remote else self._client.address()[0])
+        self.fthread = DownloadThread(self._pool, local, remote, True)
         self.fthread.callback.connect(self.fetchProgress)
         self.fthread.finished.connect(self.fetchFinished)
         self.fthread.start()
@@ -392,7 +436,13 @@ class Ui_MainWindow(object):
         resp = self.fthread.getResponse()
         self.fthread = None
         msg = '下载结果:\n\n'
-        if resp.success():
+        if resp.success() and resp.description():
+            result = msgpack.unpackb(resp.description())
+            msg += '已下载 %i 个文件。' % result['files']
+            if result['errors']:
+                msg += '\n以下 %i 项无法读取或写入，已跳过:\n' % len(result['errors'])
+                msg += '\n'.join('%s: %s' % ('/'.join(path), reason) for path, reason in result['errors'][:10])
+        elif resp.success():
             msg += '下载文件成功。'
         else:
             msg += '下载失败，原因:\n'
@@ -413,6 +463,7 @@ class Ui_MainWindow(object):
         self.actionSelect.setText(_translate("MainWindow", "添加文件... (&S)"))
         self.actionRemove.setText(_translate("MainWindow", "移除选中 (&R)"))
         self.actionClear.setText(_translate("MainWindow", "清空列表 (&C)"))
+        self.actionFetchDir.setText(_translate("MainWindow", "下载文件夹... (&D)"))
         self.actionExit.setText(_translate("MainWindow", "退出 (&X)"))
         self.actionGenerate.setText(_translate("MainWindow", "生成密钥对 (&G)"))
         self.actionRegister.setText(_translate("MainWindow", "公钥注册 (&K)"))
@@ -422,6 +473,8 @@ class Ui_MainWindow(object):
     def __del__(self):
         if self._client:
             self._client.close()
+        if self._pool:
+            self._pool.close()
 
 class Ui_ConnectionDialog(object):
     def setupUi(self, ConnectionDialog):
@@ -491,8 +544,8 @@ class Ui_ConnectionDialog(object):
             self._dialog.accept()
 
 class Ui_UploadDialog(object):
-    def __init__(self, client: Client, files, targetdir, parent: 'MainWindow'=None):
-        self._client = client
+    def __init__(self, pool: ClientPool, files, targetdir, parent: 'MainWindow'=None):
+        self._pool = pool
         self._files = files
         self._dir = targetdir
         self._total = len(files)
@@ -531,7 +584,7 @@ class Ui_UploadDialog(object):
         msg += '确定吗？'
         if QtWidgets.QMessageBox.warning(self._dialog, '上传文件', msg, QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No) != QtWidgets.QMessageBox.Yes:
             return
-        self.thread = thread = UploadThread(self._client, self._files, self._dir)
+        self.thread = thread = UploadThread(self._pool, self._files, self._dir)
         thread.finished.connect(self.finished)
         thread.callback.connect(self.progressCallback)
         thread.uploaded.connect(self.singleUploaded)
@@ -582,9 +635,9 @@ class ConnectionDialog(QtWidgets.QDialog):
         return self._client
 
 class UploadDialog(QtWidgets.QDialog):
-    def __init__(self, client: Client, files, targetdir, parent=None):
+    def __init__(self, pool: ClientPool, files, targetdir, parent=None):
         super().__init__(parent)
-        self.ui = Ui_UploadDialog(client, files, targetdir, parent)
+        self.ui = Ui_UploadDialog(pool, files, targetdir, parent)
         self.ui.setupUi(self)
     def getResults(self):
         return self.ui.getResults()
@@ -593,17 +646,25 @@ class UploadThread(QtCore.QThread):
     callback = QtCore.pyqtSignal(str, int, int, bool)
     uploaded = QtCore.pyqtSignal(str, int)
     finished = QtCore.pyqtSignal()
-    def __init__(self, client: Client, files, targetdir):
+    def __init__(self, pool: ClientPool, files, targetdir):
         super().__init__()
         self.files = files
-        self.client = client
+        self.pool = pool
         self.dir = targetdir
     def run(self):
-        for f in self.files:
-            target = self.dir + [os.path.split(f)[1],]
-            self.current = f
-            resp = self.client.upload(f, target, self._callback)
-            self.uploaded.emit(f, resp.code().value)
+        with self.pool.client() as client:
+            if len(self.files) > 1:
+                # one command, one signature for all files
+                self.current = '%i 个文件' % len(self.files)
+                resp = client.batchUpload(self.files, self.dir, self._callback)
+                for f in self.files:
+                    self.uploaded.emit(f, resp.code().value)
+            else:
+                for f in self.files:
+                    target = self.dir + [os.path.split(f)[1],]
+                    self.current = f
+                    resp = client.upload(f, target, self._callback)
+                    self.uploaded.emit(f, resp.code().value)
         self.finished.emit()
     def _callback(self, count, total, retrying):
         self.callback.emit(self.current, count, total, retrying)
@@ -611,13 +672,18 @@ class UploadThread(QtCore.QThread):
 class DownloadThread(QtCore.QThread):
     callback = QtCore.pyqtSignal(int, int)
     finished = QtCore.pyqtSignal()
-    def __init__(self, client: Client, local, remote):
+    def __init__(self, pool: ClientPool, local, remote, tree=False):
         super().__init__()
         self.local = local
         self.remote = remote
-        self.client = client
+        self.pool = pool
+        self.tree = tree
     def run(self):
-        self.resp = self.client.fetch(self.local, self.remote, self._callback)
+        with self.pool.client() as client:
+            if self.tree:
+                self.resp = client.fetchTree(self.local, self.remote, self._callback)
+            else:
+                self.resp = client.fetch(self.local, self.remote, self._callback)
         self.finished.emit()
     def getResponse(self):
         return self.resp
@@ -0,0 +1,89 @@
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+# name -> (compress, decompress with an output limit)
+CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes, int], bytes]]] = {}
+
+def _zlibDecompress(data: bytes, limit: int) -> bytes:
+    d = zlib.decompressobj()
+    out = d.decompress(data, limit)
+    if d.unconsumed_tail or not d.eof:
+        raise ValueError('corrupt or oversized zlib chunk')
+    return out
+
+CODECS['zlib'] = (lambda data: zlib.compress(data, 3), _zlibDecompress)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    def _zstdCompress(data: bytes) -> bytes:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    def _zstdDecompress(data: bytes, limit: int) -> bytes:
+        # decompress() trusts the content size in the frame header over
+        # max_output_size, so read at most one byte past the limit instead
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            out = reader.read(limit + 1)
+        if len(out) > limit:
+            raise ValueError('oversized zstd chunk')
+        return out
+    CODECS['zstd'] = (_zstdCompress, _zstdDecompress)
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    def _lz4Decompress(data: bytes, limit: int) -> bytes:
+        d = lz4.frame.LZ4FrameDecompressor()
+        out = d.decompress(data, max_length=limit)
+        if not d.eof:
+            raise ValueError('corrupt or oversized lz4 chunk')
+        return out
+    CODECS['lz4'] = (lz4.frame.compress, _lz4Decompress)
+
+# best first
+PREFERENCE = ['zstd', 'lz4', 'zlib']
+
+def available() -> List[str]:
+    'The codecs usable here, best first.'
+    return [name for name in PREFERENCE if name in CODECS]
+
+def negotiate(requested) -> Optional[str]:
+    'Picks the first codec of the peer\'s preference list supported here.'
+    if isinstance(requested, str):
+        requested = [requested]
+    for name in requested or ():
+        if name in CODECS:
+            return name
+    return None
+
+def decompress(name: str, data: bytes, limit: int) -> bytes:
+    return CODECS[name][1](data, limit)
+
+class Compressor:
+    '''
+    Compresses chunks of one transfer, returning None for chunks that do not
+    shrink so they go out as they are. After a run of incompressible chunks
+    it only probes now and then, so already compressed data costs next to
+    no CPU either.
+    '''
+    PROBE_AFTER = 4
+    PROBE_EVERY = 16
+    def __init__(self, name: str):
+        self._compress = CODECS[name][0]
+        self._misses = 0
+        self._skipped = 0
+    def compress(self, data: bytes) -> Optional[bytes]:
+        if self._misses >= self.PROBE_AFTER:
+            self._skipped += 1
+            if self._skipped < self.PROBE_EVERY:
+                return None
+            self._skipped = 0
+        packed = self._compress(data)
+        if len(packed) >= len(data):
+            self._misses += 1
+            return None
+        self._misses = 0
+        return packed
\ No newline at end of file
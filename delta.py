@@ -0,0 +1,107 @@
+import hashlib, math, mmap, struct, zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# weak (adler32) and strong checksum of one block of the server's file
+SIGNATURE = struct.Struct('>I16s')
+MIN_BLOCK = 2*1024
+MAX_BLOCK = 128*1024
+# byte-by-byte searching is slow in Python, so a transfer only rolls over
+# this many bytes in total looking for moved blocks; aligned blocks are
+# always matched
+ROLL_BUDGET = 4*1024*1024
+MOD_ADLER = 65521
+
+def block_size(size: int) -> int:
+    'About the square root of the file size in a power of two, like rsync.'
+    if size <= 0:
+        return MIN_BLOCK
+    return max(MIN_BLOCK, min(MAX_BLOCK, 1 << round(math.log2(math.sqrt(size)))))
+
+def strong(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def signatures(path: str, block: int) -> Iterator[bytes]:
+    'The packed signature of every block of the file at path.'
+    with open(path, 'rb') as stream:
+        while True:
+            data = stream.read(block)
+            if not data:
+                return
+            yield SIGNATURE.pack(zlib.adler32(data), strong(data))
+
+class Matcher:
+    '''
+    Finds the blocks of the server's file in a local file. Yields
+    ('literal', start, end, None) for local data the server lacks and
+    ('blocks', start, end, first) for local data that is a run of the
+    server's blocks from index first on; together they cover the local file
+    in order.
+    '''
+    def __init__(self, block: int, packed: List[bytes]):
+        self._block = block
+        self._blocks: Dict[int, List[Tuple[int, bytes]]] = {}
+        index = 0
+        for page in packed:
+            for weak, digest in SIGNATURE.iter_unpack(page):
+                self._blocks.setdefault(weak, []).append((index, digest))
+                index += 1
+        self._budget = ROLL_BUDGET
+    def _find(self, weak: int, data) -> int:
+        for index, digest in self._blocks.get(weak, ()):
+            if strong(data) == digest:
+                return index
+        return -1
+    def _roll(self, view, pos: int, limit: int) -> Tuple[int, int]:
+        # slides the window from pos one byte at a time, up to limit;
+        # returns (position, block index) of the first match or (-1, -1)
+        n = self._block
+        weak = zlib.adler32(view[pos:pos+n])
+        a, b = weak & 0xffff, weak >> 16
+        for start in range(pos, limit):
+            old, new = view[start], view[start+n]
+            a = (a - old + new) % MOD_ADLER
+            b = (b - n * old + a - 1) % MOD_ADLER
+            weak = b << 16 | a
+            if weak in self._blocks:
+                index = self._find(weak, view[start+1:start+1+n])
+                if index >= 0:
+                    self._budget -= start + 1 - pos
+                    return start + 1, index
+        self._budget -= limit - pos
+        return -1, -1
+    def match(self, path: str, size: int) -> Iterator[Tuple[str, int, int, Optional[int]]]:
+        if not size or not self._blocks:
+            if size:
+                yield 'literal', 0, size, None
+            return
+        n = self._block
+        with open(path, 'rb') as stream, mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            pos = literal = 0
+            run, count, start = -1, 0, 0
+            while pos < size:
+                end = min(pos + n, size)
+                index = self._find(zlib.adler32(view[pos:end]), view[pos:end])
+                if index < 0 and end - pos == n and self._budget > 0:
+                    # data was inserted or removed: look for a block further on
+                    found, index = self._roll(view, pos, min(pos + n, size - n, pos + self._budget))
+                    if index >= 0:
+                        pos, end = found, found + n
+                if index < 0:
+                    pos = end
+                    continue
+                if literal < pos:
+                    if count:
+                        yield 'blocks', start, literal, run
+                        count = 0
+                    yield 'literal', literal, pos, None
+                if count and index == run + count:
+                    count += 1
+                else:
+                    if count:
+                        yield 'blocks', start, pos, run
+                    run, count, start = index, 1, pos
+                pos = literal = end
+            if count:
+                yield 'blocks', start, literal, run
+            if literal < size:
+                yield 'literal', literal, size, None
\ No newline at end of file
@@ -0,0 +1,77 @@
+import os, threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import checksum
+from typing import Optional
+from structsock import PeerDisconnect
+from chunking import ChunkSizer
+from framing import FRAME_LENGTH
+
+HASH_BLOCK = 4*1024*1024
+
+class DigestCache:
+    'Checksums of served files or byte ranges of them, keyed by path, size and modification time.'
+    def __init__(self, size: int=1024, workers: int=2):
+        self._size = size
+        self._lock = threading.Lock()
+        self._digests = OrderedDict()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='Digest')
+    @staticmethod
+    def _compute(path: str, start: int, end: int, check: str) -> bytes:
+        hasher = checksum.new(check)
+        with open(path, 'rb') as stream:
+            stream.seek(start)
+            while start < end:
+                block = stream.read(min(HASH_BLOCK, end - start))
+                if not block: break
+                hasher.update(block)
+                start += len(block)
+        return hasher.digest()
+    def digest(self, path: str, st: os.stat_result, start: int=0, end: Optional[int]=None, check: str=checksum.DEFAULT) -> Future:
+        'Returns a future of the digest of [start, end), computing it in the background on a miss.'
+        end = st.st_size if end is None else end
+        key = (path, st.st_size, st.st_mtime_ns, start, end, check)
+        with self._lock:
+            future = self._digests.get(key)
+            if future is not None:
+                self._digests.move_to_end(key)
+                return future
+            future = self._executor.submit(self._compute, path, start, end, check)
+            self._digests[key] = future
+            while len(self._digests) > self._size:
+                self._digests.popitem(last=False)
+        future.add_done_callback(lambda f: f.exception() and self._forget(key))
+        return future
+    def _forget(self, key: tuple) -> None:
+        with self._lock:
+            self._digests.pop(key, None)
+
+class FetchEngine:
+    'Serves files as structsock frames, leaving the file body to os.sendfile.'
+    def __init__(self, cache: DigestCache):
+        self._cache = cache
+    def digest(self, path: str, st: os.stat_result, start: int=0, end: Optional[int]=None, check: str=checksum.DEFAULT) -> Future:
+        return self._cache.digest(path, st, start, end, check)
+    def serve(self, sock, stream, offset: int, end: int, chunk_size: int, digest: Future, sizer: Optional[ChunkSizer]=None) -> int:
+        '''
+        Sends [offset, end) of stream as frames, followed by the digest, and
+        returns the number of frames. With a sizer the frames vary in size and
+        an empty frame marks the end of the data.
+        '''
+        frames = 0
+        try:
+            while offset < end:
+                length = min(sizer.size() if sizer else chunk_size, end - offset)
+                sock.sendall(FRAME_LENGTH.pack(length))
+                sock.sendfile(stream, offset, length)
+                offset += length
+                frames += 1
+                if sizer:
+                    sizer.transferred(length)
+            if sizer:
+                sock.sendall(FRAME_LENGTH.pack(0))
+            digest = digest.result()
+            sock.sendall(FRAME_LENGTH.pack(len(digest)) + digest)
+        except ConnectionError:
+            raise PeerDisconnect
+        return frames
\ No newline at end of file
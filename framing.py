@@ -0,0 +1,114 @@
+import socket, struct, threading
+from typing import List, Optional, Tuple
+from structsock import PeerDisconnect, StructuredSocket
+
+# the length prefix structsock puts before every frame
+FRAME_LENGTH = struct.Struct('>I')
+# bytes of free buffers a pool keeps; the windows bound how many are in use
+POOL_BYTES = 64*1024*1024
+# room for frame headers and digests on top of a power of two sized chunk
+POOL_SLACK = 64
+WAITALL = getattr(socket, 'MSG_WAITALL', 0)
+
+class BufferPool:
+    '''
+    Reusable receive buffers. acquire hands out the smallest free buffer
+    that fits, or a new one; released buffers are kept for the next frames,
+    so a transfer in its steady state allocates none. New buffers are sized
+    to the next power of two (plus slack), so that adaptive chunks growing a
+    little do not each need a new one. At most limit bytes are kept free,
+    dropping the buffers released longest ago first.
+    '''
+    def __init__(self, limit: int=POOL_BYTES):
+        self._limit = limit
+        self._free: List[bytearray] = [] # oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+    def acquire(self, length: int) -> bytearray:
+        with self._lock:
+            fits = [b for b in self._free if len(b) >= length]
+            if fits:
+                buffer = min(fits, key=len)
+                self._free.remove(buffer)
+                self._bytes -= len(buffer)
+                return buffer
+        return bytearray(max(length, (1 << max(0, length - POOL_SLACK - 1).bit_length()) + POOL_SLACK))
+    def release(self, buffer: Optional[bytearray]) -> None:
+        if buffer is None:
+            return
+        with self._lock:
+            self._free.append(buffer)
+            self._bytes += len(buffer)
+            while self._bytes > self._limit:
+                self._bytes -= len(self._free.pop(0))
+    def size(self) -> int:
+        'Bytes of free buffers kept.'
+        return self._bytes
+
+class FrameSocket(StructuredSocket):
+    '''
+    A StructuredSocket that reads exactly one frame at a time, straight into
+    pooled buffers with recv_into, and sends the parts of a frame with one
+    sendmsg instead of concatenating them. The frames on the wire are the
+    same, so either end may still be a plain StructuredSocket.
+    '''
+    def __init__(self, s: Optional[socket.socket]=None):
+        super().__init__(s)
+        self._head = bytearray(FRAME_LENGTH.size)
+    def _fill(self, view: memoryview) -> None:
+        while view:
+            try:
+                received = self._socket.recv_into(view, len(view), WAITALL)
+            except ConnectionError:
+                raise PeerDisconnect
+            if not received:
+                raise PeerDisconnect
+            view = view[received:]
+    def _length(self) -> int:
+        self._fill(memoryview(self._head))
+        return FRAME_LENGTH.unpack(self._head)[0]
+    def recv(self) -> bytes:
+        length = self._length()
+        data = b''
+        while len(data) < length: # one read and no copy, unless a signal cuts it short
+            try:
+                more = self._socket.recv(length - len(data), WAITALL)
+            except ConnectionError:
+                raise PeerDisconnect
+            if not more:
+                raise PeerDisconnect
+            data = more if not data else data + more
+        return data
+    def recvInto(self, pool: BufferPool) -> Tuple[memoryview, bytearray]:
+        'The next frame in a buffer from pool, which the caller releases once done with it.'
+        length = self._length()
+        buffer = pool.acquire(length)
+        view = memoryview(buffer)[:length]
+        try:
+            self._fill(view)
+        except BaseException:
+            pool.release(buffer)
+            raise
+        return view, buffer
+    def send(self, data: bytes) -> None:
+        self.sendParts(data)
+    def sendParts(self, *parts) -> None:
+        'Sends the parts as one frame.'
+        length = sum(len(part) for part in parts)
+        try:
+            if not hasattr(self._socket, 'sendmsg'): # Windows
+                self._socket.sendall(FRAME_LENGTH.pack(length) + b''.join(parts))
+                return
+            views = [memoryview(FRAME_LENGTH.pack(length))] + [memoryview(part).cast('B') for part in parts if len(part)]
+            while views:
+                sent = self._socket.sendmsg(views)
+                while sent:
+                    if sent < len(views[0]):
+                        views[0] = views[0][sent:]
+                        break
+                    sent -= len(views.pop(0))
+        except OSError:
+            raise PeerDisconnect
+    def accept(self) -> Tuple['FrameSocket', Tuple[str, int]]:
+        c, addr = self._socket.accept()
+        return FrameSocket(c), addr
\ No newline at end of file
@@ -0,0 +1,122 @@
+import os, re, threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+# uploads still being received, left out of listings and so of tree fetches:
+# '.<name>.<random>.part' from transmit.temp_beside and '.<id>.part' from
+# TransmissionManager.partPath
+UPLOAD_TEMP = re.compile(r'\.(?:.+\.[a-z0-9_]{8}|[0-9a-f]{32})\.part\Z', re.S)
+
+class Listing(NamedTuple):
+    'The entries of one directory.'
+    files: List[str]
+    dirs: List[str]
+
+class Entry(NamedTuple):
+    'A directory entry; size and mtime are None unless metadata was requested.'
+    name: str
+    dir: bool
+    size: Optional[int]
+    mtime: Optional[float]
+
+class FileSystem:
+    '''
+    Resolves client paths below a base directory and lists directories
+    without touching the working directory, which is shared by every
+    session thread. The names and types in a directory are cached and
+    invalidated by the modification time of the directory; sizes and
+    mtimes are not, as changing a file does not touch its directory.
+    '''
+    def __init__(self, basedir: str, cache_size: int=256, hidden: Iterable[str]=()):
+        self._basedir = os.path.abspath(basedir)
+        # names right below the base directory that clients neither see nor reach
+        self._hidden = frozenset(hidden)
+        self._cacheSize = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+    def basedir(self) -> str:
+        return self._basedir
+    def isBase(self, path: str) -> bool:
+        return path == self._basedir
+    def resolve(self, path: Union[str, List[str], None]) -> Optional[str]:
+        'Joins a client path to the base directory; None if it escapes it.'
+        if path is None:
+            return self._basedir
+        if isinstance(path, str):
+            path = [path]
+        full = os.path.normpath(os.path.join(self._basedir, *path))
+        try:
+            if os.path.commonpath([self._basedir, full]) != self._basedir:
+                return None
+        except ValueError: # different drives
+            return None
+        if self._hidden and full != self._basedir and os.path.relpath(full, self._basedir).split(os.sep)[0] in self._hidden:
+            return None
+        return full
+    def entries(self, path: str, meta: bool=False) -> List[Entry]:
+        'The sorted entries of a directory, with size and mtime if meta is set.'
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached and cached[0] == mtime:
+                self._cache.move_to_end(path)
+            else:
+                cached = None
+        if cached:
+            return self._stat(path, cached[1]) if meta else cached[1]
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name in self._hidden and path == self._basedir or UPLOAD_TEMP.match(entry.name):
+                    continue
+                try:
+                    if entry.is_file(): isdir = False
+                    elif entry.is_dir(): isdir = True
+                    else: continue
+                    if meta:
+                        st = entry.stat() # free on Windows, one stat elsewhere
+                        entries.append(Entry(entry.name, isdir, 0 if isdir else st.st_size, st.st_mtime))
+                    else:
+                        entries.append(Entry(entry.name, isdir, None, None))
+                except OSError:
+                    pass
+        entries.sort()
+        with self._lock:
+            self._cache[path] = (mtime, [Entry(e.name, e.dir, None, None) for e in entries] if meta else entries)
+            self._cache.move_to_end(path)
+            while len(self._cache) > self._cacheSize:
+                self._cache.popitem(last=False)
+        return entries
+    @staticmethod
+    def _stat(path: str, entries: List[Entry]) -> List[Entry]:
+        stated = []
+        for entry in entries:
+            try:
+                st = os.stat(os.path.join(path, entry.name))
+            except OSError: # gone since
+                continue
+            stated.append(Entry(entry.name, entry.dir, 0 if entry.dir else st.st_size, st.st_mtime))
+        return stated
+    def stat(self, path: str, walked: Iterable[Tuple[Tuple[str, ...], Entry]]) -> List[Tuple[Tuple[str, ...], Entry]]:
+        'Fills in sizes and mtimes for entries walked below path, dropping those gone since.'
+        return [(relative, stated) for relative, entry in walked for stated in self._stat(os.path.join(path, *relative[:-1]), [entry])]
+    def listdir(self, path: str) -> Listing:
+        files, dirs = [], []
+        for entry in self.entries(path):
+            (dirs if entry.dir else files).append(entry.name)
+        return Listing(files, dirs)
+    def walk(self, path: str, depth: int=1, meta: bool=False, prefix: Tuple[str, ...]=(), onerror: Optional[Callable[[Tuple[str, ...], OSError], None]]=None) -> Iterator[Tuple[Tuple[str, ...], Entry]]:
+        '''
+        Yields (relative path, entry) for everything below path, descending
+        depth levels. Subdirectories that cannot be read are skipped, after
+        passing their relative path and the error to onerror if given.
+        '''
+        for entry in self.entries(path, meta):
+            relative = prefix + (entry.name,)
+            yield relative, entry
+            if entry.dir and depth > 1:
+                try:
+                    yield from self.walk(os.path.join(path, entry.name), depth - 1, meta, relative, onerror)
+                except OSError as e:
+                    if onerror:
+                        onerror(relative, e)
\ No newline at end of file
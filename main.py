@@ -4,7 +4,14 @@ HOST = 'localhost'
 PORT = 5000
 
 from channels import Server
-import logging, time
+import logging, time, metrics
+
+def option(name: str, default: int, cast: type=int) -> int:
+    prefix = '-%s=' % name
+    for arg in sys.argv:
+        if arg.startswith(prefix):
+            return cast(arg[len(prefix):])
+    return default
 
 def wait_forever():
     try:
@@ -34,9 +41,19 @@ if not '-nolog' in sys.argv:
 if '-stop' in sys.argv:
     print('Stopping server...')
 
-s = Server(PORT)
+if '-async' in sys.argv:
+    from aserver import AsyncServer
+    s = AsyncServer(PORT, max_transfers=option('transfers', 8), per_host=option('perhost', 2),
+                    backlog=option('backlog', 1024), max_sessions=option('sessions', 4096), workers=option('workers', 32),
+                    profile='-profile' in sys.argv, dedup='-dedup' in sys.argv, sync=option('sync', 'none', str))
+else:
+    s = Server(PORT, max_transfers=option('transfers', 8), per_host=option('perhost', 2), backlog=option('backlog', 128),
+               profile='-profile' in sys.argv, dedup='-dedup' in sys.argv, sync=option('sync', 'none', str))
 s.prepare()
 logging.info('Server running on 0.0.0.0:%i' % PORT)
+if option('metrics', 0):
+    metrics.serve(s.metrics(), option('metrics', 0))
+    logging.info('Metrics on http://127.0.0.1:%i/' % option('metrics', 0))
 if '-block' in sys.argv:
     s.serve()
 else:
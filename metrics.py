@@ -0,0 +1,127 @@
+import functools, json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Optional, Tuple
+
+class Histogram:
+    'Latencies in power of two microsecond buckets, with count, total and max.'
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets: Dict[int, int] = {}
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = 1 << max(0, int(seconds * 1e6)).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    def quantile(self, q: float) -> float:
+        'Upper bound of the bucket holding the q quantile, in seconds.'
+        rank, seen = q * self.count, 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return bucket / 1e6
+        return 0.0
+    def snapshot(self) -> dict:
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+class Timer:
+    def __init__(self, metrics: 'Metrics', name: str):
+        self._metrics = metrics
+        self._name = name
+    def __enter__(self) -> 'Timer':
+        self._start = time.perf_counter()
+        return self
+    def __exit__(self, *exc) -> None:
+        self._metrics.observe(self._name, time.perf_counter() - self._start)
+
+class Metrics:
+    '''
+    Counters and latency histograms. Updates also go to the parent, so a
+    session's numbers add up into the server-wide ones.
+    '''
+    def __init__(self, parent: Optional['Metrics']=None):
+        self._parent = parent
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {}
+        self._histograms: Dict[str, Histogram] = {}
+        self._started = time.time()
+    def add(self, name: str, value: int=1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        if self._parent:
+            self._parent.add(name, value)
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+        if self._parent:
+            self._parent.observe(name, seconds)
+    def timer(self, name: str) -> Timer:
+        return Timer(self, name)
+    def snapshot(self) -> dict:
+        with self._lock:
+            uptime = time.time() - self._started
+            counters = dict(self._counters)
+            rates = {name + '/s': value / uptime for name, value in counters.items() if name.startswith(('bytes', 'chunks'))}
+            return {'uptime': uptime, 'counters': counters, 'rates': rates,
+                    'timers': {name: h.snapshot() for name, h in self._histograms.items()}}
+
+def format_text(snapshot: dict) -> str:
+    'One "name value" line per number, for people and line based scrapers.'
+    lines = ['uptime %.1f' % snapshot['uptime']]
+    lines += ['%s %i' % item for item in sorted(snapshot['counters'].items())]
+    lines += ['%s %.1f' % item for item in sorted(snapshot['rates'].items())]
+    for name, timer in sorted(snapshot['timers'].items()):
+        lines += ['%s.%s %.6g' % (name, key, value) for key, value in timer.items()]
+    return '\n'.join(lines) + '\n'
+
+def instrument(targets: Iterable[Tuple[type, str]], metrics: Metrics) -> None:
+    '''
+    Wraps the given methods with timers recording into metrics as
+    "Class.method". Meant for finding bottlenecks; it costs a clock read and
+    a lock per call, so it is only switched on when asked for.
+    '''
+    for cls, name in targets:
+        attribute = cls.__dict__[name]
+        static = isinstance(attribute, staticmethod)
+        func = attribute.__func__ if static else attribute
+        if getattr(func, '__timed__', False):
+            continue
+        label = '%s.%s' % (cls.__name__, name)
+        @functools.wraps(func)
+        def timed(*args, _func=func, _label=label, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _func(*args, **kwargs)
+            finally:
+                metrics.observe(_label, time.perf_counter() - start)
+        timed.__timed__ = True
+        setattr(cls, name, staticmethod(timed) if static else timed)
+
+def serve(metrics: Metrics, port: int, host: str='127.0.0.1') -> ThreadingHTTPServer:
+    'Serves the metrics as text on / and as JSON on /json, in a daemon thread.'
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            snapshot = metrics.snapshot()
+            if self.path.rstrip('/') == '/json':
+                body, kind = json.dumps(snapshot).encode(), 'application/json'
+            else:
+                body, kind = format_text(snapshot).encode(), 'text/plain; charset=utf-8'
+            self.send_response(200)
+            self.send_header('Content-Type', kind)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+    return server
\ No newline at end of file
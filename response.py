@@ -18,6 +18,7 @@ class RespCode(IntEnum):
     RCE_NO_SUCH_COMMAND = 9
     RCE_ACCESS_DENIED = 10
     RCE_TRANSMITTER_OCCUPIED = 11
+    RCE_TRANSFER_UNKNOWN = 12
 
 class Response:
     'The response object sent by the server.'
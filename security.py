@@ -1,20 +1,53 @@
-from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
+from Crypto.PublicKey import RSA, ECC
+from Crypto.Signature import pkcs1_15, eddsa
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA384, SHA512
 from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Util.Padding import pad, unpad
-from hashlib import sha256, md5
-from typing import Tuple
-import os, glob, string, random
+from hashlib import sha256
+from typing import Dict, List, Optional, Tuple, Union
+import os, glob, string, random, sqlite3, threading
+import checksum
 
 AES_KEY_SIZE = 32
 
+# RSA keys sign with PKCS#1 v1.5, Ed25519 keys with EdDSA
+Key = Union[RSA.RsaKey, ECC.EccKey]
+
+def import_key(data: bytes) -> Key:
+    'Imports an RSA or Ed25519 key from PEM or DER.'
+    try:
+        return RSA.import_key(data)
+    except ValueError:
+        return ECC.import_key(data)
+
+def export_key(key: Key, format: str='DER') -> bytes:
+    if isinstance(key, RSA.RsaKey):
+        return key.export_key(format)
+    data = key.export_key(format=format)
+    return data.encode() if isinstance(data, str) else data
+
+def public_key(key: Key) -> Key:
+    return key.publickey() if isinstance(key, RSA.RsaKey) else key.public_key()
+
+class EdDSASigner:
+    'EdDSA over the digest of a hash object, so both key types sign the same SHA384 hashes.'
+    def __init__(self, key: ECC.EccKey):
+        self._scheme = eddsa.new(key, 'rfc8032')
+    def sign(self, data: SHA384.SHA384Hash) -> bytes:
+        return self._scheme.sign(data.digest())
+    def verify(self, data: SHA384.SHA384Hash, signature: bytes) -> None:
+        self._scheme.verify(data.digest(), signature)
+
+def new_signer(key: Key):
+    'A signature scheme for key with sign(hash) and verify(hash, signature).'
+    return pkcs1_15.new(key) if isinstance(key, RSA.RsaKey) else EdDSASigner(key)
+
 class KeyExport:
-    def __init__(self, key: RSA.RsaKey):
+    def __init__(self, key: Key):
         self._key = key
     def asBytes(self) -> bytes:
-        return self._key.export_key('DER')
+        return export_key(self._key)
     def __bytes__(self):
         return self.asBytes()
     def asHex(self) -> str:
@@ -22,90 +55,195 @@ class KeyExport:
     def identifier(self) -> str:
         hashed = sha256(self.asBytes()).hexdigest()
         return ':'.join(hashed[x:x+4] for x in range(0, len(hashed), 4))
-    def key(self) -> RSA.RsaKey:
+    def key(self) -> Key:
         return self._key
+    def isRSA(self) -> bool:
+        return isinstance(self._key, RSA.RsaKey)
     def publicKey(self) -> 'KeyExport':
-        return KeyExport(self._key.publickey())
+        return KeyExport(public_key(self._key))
     @staticmethod
     def load(file):
         data = open(file, 'rb').read()
-        key = RSA.import_key(data)
+        key = import_key(data)
         return KeyExport(key)
 
 class HostKeyMap(dict):
+    'Trusted host keys, with a verifier and identifier cached per host.'
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._changed = set()
+        self._verifiers: Dict[str, object] = {}
+        self._identifiers: Dict[str, str] = {}
     def containsHost(self, host: str) -> bool:
         return self.__contains__(host)
-    def keyOf(self, host: str) -> RSA.RsaKey:
+    def keyOf(self, host: str) -> Key:
         return self.__getitem__(host)
     def identifierOf(self, host: str) -> str:
-        return KeyExport(self.keyOf(host)).identifier()
+        identifier = self._identifiers.get(host)
+        if identifier is None:
+            identifier = self._identifiers[host] = KeyExport(self.keyOf(host)).identifier()
+        return identifier
     def verify(self, host: str, data: SHA384.SHA384Hash, signature: bytes):
-        signer = pkcs1_15.new(self.__getitem__(host))
+        verifier = self._verifiers.get(host)
+        if verifier is None:
+            verifier = self._verifiers[host] = new_signer(self.__getitem__(host))
         try:
-            signer.verify(data, signature)
+            verifier.verify(data, signature)
             return True
         except ValueError:
             return False
     def makeTrust(self, host: str, key_der: bytes) -> None:
-        key = RSA.import_key(key_der)
-        self.__setitem__(host, key)
-        self._changed.add(host)
-    def __setitem__(self, host: str, key: RSA.RsaKey) -> None:
+        self.__setitem__(host, import_key(key_der))
+    def __setitem__(self, host: str, key: Key) -> None:
         super().__setitem__(host, key)
+        self._verifiers.pop(host, None)
+        self._identifiers.pop(host, None)
         self._changed.add(host)
+    def __delitem__(self, host: str) -> None:
+        super().__delitem__(host)
+        self._verifiers.pop(host, None)
+        self._identifiers.pop(host, None)
     def save(self, dir: str) -> None:
-        cur = os.getcwd()
-        os.chdir(dir)
-        for host in self._changed:
-            open(host + '.pem', 'wb').write(self.__getitem__(host).export_key('PEM'))
-        os.chdir(cur)
-        self._changed.clear()
+        for host in list(self._changed):
+            with open(os.path.join(dir, host + '.pem'), 'wb') as f:
+                f.write(export_key(self.__getitem__(host), 'PEM'))
+            self._changed.discard(host)
     @staticmethod
     def scan(dir: str) -> 'HostKeyMap':
         pairs = []
-        cur = os.getcwd()
-        os.chdir(dir)
-        for pem in glob.iglob('*.pem'):
-            host = os.path.splitext(pem)[0]
-            key = RSA.import_key(open(pem, 'rb').read())
+        for pem in glob.iglob(os.path.join(glob.escape(dir), '*.pem')):
+            host = os.path.splitext(os.path.basename(pem))[0]
+            with open(pem, 'rb') as f:
+                key = import_key(f.read())
             pairs.append((host, key))
-        os.chdir(cur)
         return HostKeyMap(pairs)
 
+class TrustStore:
+    '''
+    Trusted host keys in one sqlite file. Lookups go to the indexed table and
+    keys are only parsed when a host's signature is verified; every change
+    is its own transaction, so the file is never left half written.
+    '''
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._verifiers: Dict[str, object] = {}
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS hosts (host TEXT PRIMARY KEY, key BLOB NOT NULL, identifier TEXT NOT NULL)')
+    def _row(self, host: str) -> Optional[tuple]:
+        with self._lock:
+            return self._db.execute('SELECT key, identifier FROM hosts WHERE host = ?', (host,)).fetchone()
+    def containsHost(self, host: str) -> bool:
+        return self._row(host) is not None
+    def hosts(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT host FROM hosts ORDER BY host')]
+    def keyOf(self, host: str) -> Key:
+        row = self._row(host)
+        if row is None:
+            raise KeyError(host)
+        return import_key(row[0])
+    def identifierOf(self, host: str) -> str:
+        row = self._row(host)
+        if row is None:
+            raise KeyError(host)
+        return row[1]
+    def verify(self, host: str, data: SHA384.SHA384Hash, signature: bytes) -> bool:
+        row = self._row(host)
+        if row is None:
+            return False
+        # keyed by identifier, so a replaced key never meets a stale verifier
+        verifier = self._verifiers.get(row[1])
+        if verifier is None:
+            verifier = self._verifiers[row[1]] = new_signer(import_key(row[0]))
+        try:
+            verifier.verify(data, signature)
+            return True
+        except ValueError:
+            return False
+    def makeTrust(self, host: str, key_der: bytes) -> bool:
+        'Trusts key for host; returns whether anything changed.'
+        export = KeyExport(import_key(key_der))
+        der = export.asBytes()
+        row = self._row(host)
+        if row is not None and row[0] == der:
+            return False
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO hosts VALUES (?, ?, ?)', (host, der, export.identifier()))
+        return True
+    def distrust(self, host: str) -> None:
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM hosts WHERE host = ?', (host,))
+    def migrate(self, dir: str) -> int:
+        'Imports the PEM files of the old per-host directory for hosts not stored yet.'
+        count = 0
+        for pem in glob.iglob(os.path.join(glob.escape(dir), '*.pem')):
+            host = os.path.splitext(os.path.basename(pem))[0]
+            if self.containsHost(host):
+                continue
+            try:
+                with open(pem, 'rb') as f:
+                    self.makeTrust(host, export_key(import_key(f.read())))
+                count += 1
+            except (OSError, ValueError):
+                print('Skipped unreadable key file:', pem)
+        return count
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
 class LocalSecurity:
-    def __init__(self, private: RSA.RsaKey, public: RSA.RsaKey):
+    def __init__(self, private: Key, public: Key, signer=None):
         self._privateKey = private
         self._publicKey = public
-        self._signer = pkcs1_15.new(self._privateKey)
+        self._signer = signer or new_signer(self._privateKey)
         self._hash = SHA384.new()
     @staticmethod
-    def generate() -> 'LocalSecurity':
-        private = RSA.generate(1024)
-        public = private.publickey()
-        return LocalSecurity(private, public)
+    def generate(kind: str='rsa', bits: int=1024) -> 'LocalSecurity':
+        '''
+        Generates an RSA key of bits, which every server accepts, or an Ed25519
+        key with kind "ed25519", which needs a newer server. Larger RSA keys are
+        safer but sign slower: 3072 bits costs about ten times 1024 per
+        signature, Ed25519 sits in between.
+        '''
+        if kind == 'ed25519':
+            private = ECC.generate(curve='Ed25519')
+        else:
+            private = RSA.generate(bits)
+        return LocalSecurity(private, public_key(private))
     @staticmethod
     def load(pem: str) -> 'LocalSecurity':
         private = open(pem, 'rb').read()
-        private = RSA.import_key(private)
-        public = private.publickey()
+        private = import_key(private)
+        public = public_key(private)
         return LocalSecurity(private, public)
     def save(self, pem: str) -> None:
-        open(pem, 'wb').write(self._privateKey.export_key('PEM'))
+        open(pem, 'wb').write(export_key(self._privateKey, 'PEM'))
     def export(self) -> KeyExport:
         return KeyExport(self._publicKey)
-    def chunk(self, data: bytes):
+    def chunk(self, data: bytes, check: str=checksum.DEFAULT) -> bytes:
+        'Feeds the signature hash and returns the frame checksum of data.'
         self._hash.update(data)
-        return md5(data).digest()
+        return checksum.digest(check, data)
+    def update(self, data: bytes) -> None:
+        'Feeds the signature hash only, for data the peer already has.'
+        self._hash.update(data)
+    def fork(self) -> 'LocalSecurity':
+        'The same keys with a hash of its own, for hashing in another thread.'
+        return LocalSecurity(self._privateKey, self._publicKey, self._signer)
+    def digest(self) -> bytes:
+        return self._hash.digest()
+    def sign(self, data: SHA384.SHA384Hash) -> bytes:
+        return self._signer.sign(data)
+    def reset(self) -> None:
+        self._hash = SHA384.new()
     def finish(self) -> bytes:
         signature = self._signer.sign(self._hash)
         self._hash = SHA384.new()
         return signature
 
 class RemoteSecurity:
-    def __init__(self, hostKeyMap: HostKeyMap):
+    def __init__(self, hostKeyMap: Union[HostKeyMap, TrustStore]):
         self._map = hostKeyMap
     def verify(self, host: str, data: SHA384.SHA384Hash, signature: bytes) -> bool:
         return self._map.verify(host, data, signature)
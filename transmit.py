@@ -1,44 +1,740 @@
-import socket, shutil, tempfile, os
-from security import RemoteSecurity, HostKeyMap
+import socket, shutil, tempfile, os, struct, uuid, json, time, queue, errno
+from security import RemoteSecurity, HostKeyMap, TrustStore
 from Crypto.Hash import SHA384
-from hashlib import md5
+import checksum, metrics
+from cas import ChunkStore
+from threading import Condition, Lock, Thread, current_thread, local
+from collections import deque, Counter
+from typing import Callable, Optional, List, Tuple, Union
+
+# one record per committed chunk: length and checksum of the chunk, zero padded
+JOURNAL_RECORD = struct.Struct('>I16s')
+
+# when received data is forced to disk: never (the OS decides), once before
+# a finished upload is put in place, or every SYNC_BYTES while receiving too
+SYNC_NONE, SYNC_FINISH, SYNC_PERIODIC = 'none', 'finish', 'periodic'
+SYNC_POLICIES = (SYNC_NONE, SYNC_FINISH, SYNC_PERIODIC)
+SYNC_BYTES = 64*1024*1024
+
+_seekLock = Lock()
+
+def pwrite(fd: int, data: bytes, offset: int) -> None:
+    'Writes data at offset; safe to call from several threads on the same fd.'
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view, offset = view[written:], offset + written
+    else:
+        with _seekLock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+def sync(fd: int) -> None:
+    (os.fdatasync if hasattr(os, 'fdatasync') else os.fsync)(fd)
+
+def sync_dir(path: str) -> None:
+    'Makes a rename in the directory durable; not possible (nor needed) on Windows.'
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def preallocate(fd: int, size: int) -> None:
+    'Reserves size bytes for the file, so that it is laid out in one piece and a full disk shows early.'
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+    except OSError:
+        pass # not supported here; the writes will report a full disk
+
+def temp_beside(path: str) -> Tuple[int, str]:
+    '''
+    A hidden temp file in the directory of path, so that putting it in place
+    is a rename; in the system temp directory if that directory does not
+    exist (yet) or cannot be written to.
+    '''
+    directory, name = os.path.split(path)
+    try:
+        return tempfile.mkstemp(prefix='.%s.' % name, suffix='.part', dir=directory)
+    except (FileNotFoundError, PermissionError):
+        return tempfile.mkstemp()
+
+def place(temp: str, path: str, durable: bool=False) -> None:
+    'Replaces path with temp atomically; a copy only if they are on different file systems.'
+    try:
+        os.replace(temp, path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(temp, path)
+    if durable:
+        sync_dir(os.path.dirname(path))
 
 class IntegrityError(Exception):
     pass
 
-class Transmitter(RemoteSecurity):
-    def __init__(self, hostKeyMap: HostKeyMap):
-        super().__init__(hostKeyMap)
-        self._hash = self._temp = self._fd = self._host = self._file = None
-    def transmission(self, host: str, file: str) -> bool:
-        print('New transmission from %s: %s' % (host, file))
-        if self._host:
-            return False
+class ChunkWriter:
+    '''
+    Writes the chunks of one transfer in order on a thread of its own, so
+    that the session can go on receiving while the disk and the signature
+    hash catch up. The queue is bounded: once the disk falls behind, put
+    blocks, the session stops reading and TCP pushes back on the sender.
+    '''
+    def __init__(self, t: Union['Transmitter', 'BatchTransmitter', 'ByteRange'], depth: int, metrics: Optional[metrics.Metrics]=None, recycle: Optional[Callable[[bytearray], None]]=None):
+        self._t = t
+        self._recycle = recycle
+        self._queue = queue.Queue(depth)
+        self._metrics = metrics
+        self._error = None
+        self._thread = Thread(target=self._run, name=current_thread().name + '-Writer', daemon=True)
+        self._thread.start()
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            data, digest, buffer = item
+            if self._error is not None:
+                self._queue.task_done()
+                continue # only drained, so that put never blocks for good
+            try:
+                started = time.perf_counter()
+                self._t.write(data, digest)
+                if self._recycle and buffer is not None:
+                    self._recycle(buffer) # data may be a view of it
+                if self._metrics:
+                    self._metrics.observe('time.write', time.perf_counter() - started)
+                    self._metrics.add('chunks_in')
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+    def put(self, data: bytes, digest: Optional[bytes]=None, buffer: Optional[bytearray]=None) -> None:
+        'Queues data for writing; buffer, if data lives in one, is recycled once written.'
+        if self._error is not None:
+            raise self._error
+        self._queue.put((data, digest, buffer))
+    def drain(self) -> None:
+        'Waits until everything queued so far is written; raises what writing raised.'
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+    def close(self) -> None:
+        'Waits until everything queued is written; raises what writing raised.'
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+class Transmitter:
+    def __init__(self, manager: 'TransmissionManager', host: str, file: str, transfer_id: Optional[str]=None, check: str=checksum.DEFAULT, size: Optional[int]=None):
+        self._manager = manager
         self._host = host
-        self._hash = SHA384.new()
-        self._fd, self._temp = tempfile.mkstemp()
         self._file = file
-        return True
-    def chunk(self, data: bytes, expected_digest: bytes) -> None:
-        if md5(data).digest() != expected_digest:
+        self._check = check
+        self._hash = SHA384.new()
+        self._id = transfer_id
+        self._chunks = 0
+        self._size = 0
+        self._unsynced = 0
+        self._journal = None
+        if transfer_id is None:
+            self._fd, self._temp = manager.temp(file)
+        else:
+            self._temp = manager.partPath(transfer_id, file)
+            self._fd = os.open(self._temp, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o600)
+            self._restore()
+            self._journal = open(manager.journalPath(transfer_id, '.log'), 'ab')
+        if size and size > self._size:
+            preallocate(self._fd, size) # finish cuts off whatever was not sent
+    def _restore(self) -> None:
+        # rehash the journaled prefix; anything after the first chunk that
+        # does not match its record was not written durably and is dropped
+        log = self._manager.journalPath(self._id, '.log')
+        records = open(log, 'rb').read() if os.path.isfile(log) else b''
+        offset = 0
+        for i in range(len(records) // JOURNAL_RECORD.size):
+            length, digest = JOURNAL_RECORD.unpack_from(records, i * JOURNAL_RECORD.size)
+            data = os.pread(self._fd, length, offset) if hasattr(os, 'pread') else self._readAt(length, offset)
+            if len(data) != length or checksum.digest(self._check, data) != digest[:checksum.size(self._check)]:
+                break
+            self._hash.update(data)
+            offset += length
+            self._chunks += 1
+        self._size = offset
+        os.ftruncate(self._fd, offset)
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        with open(log, 'wb') as f:
+            f.write(records[:self._chunks * JOURNAL_RECORD.size])
+    def _readAt(self, length: int, offset: int) -> bytes:
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        return os.read(self._fd, length)
+    def host(self) -> str:
+        return self._host
+    def file(self) -> str:
+        return self._file
+    def id(self) -> Optional[str]:
+        return self._id
+    def chunks(self) -> int:
+        return self._chunks
+    def size(self) -> int:
+        'Bytes received so far.'
+        return self._size
+    def check(self, data: bytes, expected_digest: bytes) -> None:
+        if checksum.digest(self._check, data) != expected_digest:
             raise IntegrityError
+    def write(self, data: bytes, digest: Optional[bytes]=None) -> None:
         os.write(self._fd, data)
         self._hash.update(data)
-    def finish(self, expected_signature: bytes) -> bool:
+        self._chunks += 1
+        self._size += len(data)
+        self._unsynced += len(data)
+        if self._journal:
+            self._journal.write(JOURNAL_RECORD.pack(len(data), digest or checksum.digest(self._check, data)))
+            self._journal.flush()
+        if self._unsynced >= SYNC_BYTES and self._manager.syncPolicy() == SYNC_PERIODIC:
+            self._unsynced = 0
+            sync(self._fd)
+            if self._journal:
+                os.fsync(self._journal.fileno())
+    def chunk(self, data: bytes, expected_digest: bytes) -> None:
+        self.check(data, expected_digest)
+        self.write(data, expected_digest)
+    def _close(self) -> None:
         os.close(self._fd)
-        ret = self.verify(self._host, self._hash, expected_signature)
-        self._fd = self._host = None
-        if not ret:
+        self._fd = None
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+    def finish(self, expected_signature: bytes) -> bool:
+        durable = self._manager.syncPolicy() != SYNC_NONE
+        try:
+            os.ftruncate(self._fd, self._size) # the preallocated space not used
+            if durable:
+                sync(self._fd)
+        finally:
+            self._close()
+        try:
+            if not self._manager.verify(self._host, self._hash, expected_signature):
+                os.unlink(self._temp)
+                return False
+            try:
+                place(self._temp, self._file, durable)
+            except OSError:
+                os.unlink(self._temp)
+                raise
+            return True
+        finally:
+            self._manager.forget(self._temp)
+            self._manager.discard(self._id)
+            self._manager.release(self)
+    def abort(self) -> None:
+        if self._fd is not None:
+            self._close()
             os.unlink(self._temp)
-            self._temp = self._file = None
-            return False
-        else:
+            self._manager.forget(self._temp)
+            self._manager.discard(self._id)
+            self._manager.release(self)
+    def suspend(self) -> None:
+        'Keeps a journaled transfer on disk so that it can be resumed later.'
+        if self._id is None:
+            self.abort()
+        elif self._fd is not None:
+            self._close()
+            self._manager.release(self)
+
+class BatchTransmitter:
+    '''
+    Receives the concatenated contents of many files as one chunk stream and
+    splits it at the sizes given in the manifest. One signature over the
+    manifest and all the data covers the whole batch.
+    '''
+    def __init__(self, manager: 'TransmissionManager', host: str, manifest: bytes, files: List[Tuple[str, int]], dirs: List[str]):
+        self._manager = manager
+        self._host = host
+        self._files = files
+        self._dirs = dirs
+        self._hash = SHA384.new(manifest)
+        self._chunks = 0
+        self._temps = []
+        self._index = 0
+        self._remaining = files[0][1] if files else 0
+        self._fd = None
+        self._unsynced = 0
+        self._open = True
+        self._next()
+    def _next(self) -> None:
+        # opens temp files until one still expects data; empty files need none
+        while self._index < len(self._files):
+            if self._fd is None:
+                self._fd, temp = self._manager.temp(self._files[self._index][0])
+                self._temps.append(temp)
+                preallocate(self._fd, self._remaining)
+            if self._remaining:
+                return
+            if self._manager.syncPolicy() != SYNC_NONE:
+                sync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+            self._index += 1
+            if self._index < len(self._files):
+                self._remaining = self._files[self._index][1]
+    def host(self) -> str:
+        return self._host
+    def id(self) -> None:
+        return None
+    def chunks(self) -> int:
+        return self._chunks
+    def write(self, data: bytes, digest: Optional[bytes]=None) -> None:
+        self._hash.update(data)
+        self._chunks += 1
+        view = memoryview(data)
+        while view:
+            if self._fd is None:
+                raise IntegrityError # more data than the manifest announced
+            part = view[:self._remaining]
+            os.write(self._fd, part)
+            self._remaining -= len(part)
+            self._unsynced += len(part)
+            if self._unsynced >= SYNC_BYTES and self._manager.syncPolicy() == SYNC_PERIODIC:
+                self._unsynced = 0
+                sync(self._fd)
+            view = view[len(part):]
+            self._next()
+    def _cleanup(self) -> None:
+        self._open = False
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        for temp in self._temps:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            self._manager.forget(temp)
+    def finish(self, expected_signature: bytes) -> bool:
+        try:
+            if self._fd is not None or not self._manager.verify(self._host, self._hash, expected_signature):
+                return False
+            for path in self._dirs:
+                os.makedirs(path, exist_ok=True)
+            durable = self._manager.syncPolicy() != SYNC_NONE
+            for temp, (path, _) in zip(self._temps, self._files):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                place(temp, path, durable)
+            return True
+        finally:
+            self._cleanup()
+            self._manager.release(self)
+    def abort(self) -> None:
+        if self._open:
+            self._cleanup()
+            self._manager.release(self)
+    suspend = abort
+
+class StoreTransmitter:
+    '''
+    Receives a file for a ChunkStore: only the chunks the store lacks are
+    sent, the file is assembled from the store and placed at its
+    destination once the signature over its content checks out.
+    '''
+    def __init__(self, manager: 'TransmissionManager', host: str, file: str, store: ChunkStore, keys: List[bytes]):
+        self._manager = manager
+        self._host = host
+        self._file = file
+        self._store = store
+        self._keys = keys
+        self._missing = store.missing(keys)
+        self._open = True
+    def host(self) -> str:
+        return self._host
+    def id(self) -> None:
+        return None
+    def missing(self) -> List[int]:
+        'Indices of the chunks to be sent, in the order they are expected.'
+        return self._missing
+    def put(self, index: int, data: bytes) -> None:
+        if not self._store.put(self._keys[index], data):
+            raise IntegrityError
+    def finish(self, expected_signature: bytes) -> bool:
+        try:
+            path, hasher = self._store.assemble(self._keys)
+            if not self._manager.verify(self._host, hasher, expected_signature):
+                return False
+            self._store.place(path, self._file)
+            return True
+        finally:
+            self.abort()
+    def abort(self) -> None:
+        if self._open:
+            self._open = False
+            self._manager.release(self)
+    suspend = abort
+
+class ByteRange:
+    'One range of a RangeTransmitter, received over its own connection.'
+    def __init__(self, parent: 'RangeTransmitter', offset: int, length: int):
+        self._parent = parent
+        self._offset = offset
+        self._length = length
+        self._written = 0
+        self._chunks = 0
+        self._hash = SHA384.new()
+        self.claimed = False
+    def chunks(self) -> int:
+        return self._chunks
+    def complete(self) -> bool:
+        return self._written == self._length
+    def digest(self) -> bytes:
+        return self._hash.digest()
+    def write(self, data: bytes, digest: Optional[bytes]=None) -> None:
+        if self._written + len(data) > self._length:
+            raise IntegrityError # more data than the range holds
+        self._parent.writeAt(data, self._offset + self._written)
+        self._written += len(data)
+        self._hash.update(data)
+        self._chunks += 1
+
+class RangeTransmitter:
+    '''
+    Receives one file as byte ranges sent in parallel, written in place into
+    a preallocated temp file. The client signs the SHA384 of the
+    concatenated SHA384 digests of the ranges, a two level hash tree.
+    '''
+    def __init__(self, manager: 'TransmissionManager', host: str, file: str, size: int, ranges: List[List[int]]):
+        position = 0
+        for offset, length in ranges:
+            if offset != position or length <= 0:
+                raise ValueError('ranges must cover the file in order')
+            position += length
+        if position != size:
+            raise ValueError('ranges must cover the file in order')
+        self._manager = manager
+        self._host = host
+        self._file = file
+        self._id = uuid.uuid4().hex
+        self._ranges = [ByteRange(self, offset, length) for offset, length in ranges]
+        self._fd, self._temp = manager.temp(file)
+        self._syncLock = Lock()
+        self._unsynced = 0
+        preallocate(self._fd, size)
+        os.ftruncate(self._fd, size) # in case preallocating is not supported
+    def host(self) -> str:
+        return self._host
+    def id(self) -> str:
+        return self._id
+    def range(self, index: int) -> ByteRange:
+        return self._ranges[index]
+    def count(self) -> int:
+        return len(self._ranges)
+    def writeAt(self, data: bytes, offset: int) -> None:
+        pwrite(self._fd, data, offset)
+        if self._manager.syncPolicy() != SYNC_PERIODIC:
+            return
+        with self._syncLock:
+            self._unsynced += len(data)
+            due = self._unsynced >= SYNC_BYTES
+            if due:
+                self._unsynced = 0
+        if due:
+            sync(self._fd)
+    def finish(self, expected_signature: bytes) -> bool:
+        durable = self._manager.syncPolicy() != SYNC_NONE
+        try:
+            if durable:
+                sync(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+        try:
+            root = SHA384.new(b''.join(r.digest() for r in self._ranges))
+            if not all(r.complete() for r in self._ranges) or not self._manager.verify(self._host, root, expected_signature):
+                os.unlink(self._temp)
+                return False
             try:
-                shutil.move(self._temp, self._file)
-            except PermissionError:
+                place(self._temp, self._file, durable)
+            except OSError:
                 os.unlink(self._temp)
                 raise
-            self._temp = self._file = None
             return True
-    def trusted(self) -> HostKeyMap:
+        finally:
+            self._manager.forget(self._temp)
+            self._manager.release(self)
+    def abort(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            os.unlink(self._temp)
+            self._manager.forget(self._temp)
+            self._manager.release(self)
+    suspend = abort
+
+class TransmissionManager(RemoteSecurity):
+    def __init__(self, hostKeyMap: Union[HostKeyMap, TrustStore], max_transfers: int=8, per_host: int=2, queue_timeout: Optional[float]=None, journal_dir: Optional[str]=None, metrics: Optional['metrics.Metrics']=None, sync: str=SYNC_NONE):
+        super().__init__(hostKeyMap)
+        if sync not in SYNC_POLICIES:
+            raise ValueError('sync must be one of %s' % ', '.join(SYNC_POLICIES))
+        self._sync = sync
+        self._metrics = metrics
+        self._maxTransfers = max_transfers
+        self._perHost = per_host
+        self._queueTimeout = queue_timeout
+        self._listeners: List[Callable[[], None]] = []
+        self._granted = local() # a slot admitted ahead of time, see granted
+        self._cond = Condition()
+        self._queue = deque()
+        self._active = Counter()
+        self._journalDir = journal_dir
+        self._journaled = set()
+        self._temps = set()
+        self._ranged = {}
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+    def verify(self, host: str, data: SHA384.SHA384Hash, signature: bytes) -> bool:
+        if self._metrics is None:
+            return super().verify(host, data, signature)
+        with self._metrics.timer('verify'):
+            return super().verify(host, data, signature)
+    def syncPolicy(self) -> str:
+        return self._sync
+    def journalPath(self, transfer_id: str, ext: str) -> str:
+        return os.path.join(self._journalDir, transfer_id + ext)
+    def _tempRecord(self, temp: str) -> str:
+        return os.path.join(self._journalDir, os.path.basename(temp) + '.temp')
+    def temp(self, path: str) -> Tuple[int, str]:
+        '''
+        A temp file beside path, see temp_beside. With a journal directory
+        it is recorded there until forgotten, so that purge can remove it
+        should the server die before putting it in place.
+        '''
+        fd, temp = temp_beside(path)
+        if self._journalDir:
+            with self._cond:
+                self._temps.add(temp)
+            with open(self._tempRecord(temp), 'w', encoding='utf-8') as f:
+                f.write(temp)
+        return fd, temp
+    def forget(self, temp: str) -> None:
+        'The temp file was put in place or removed.'
+        if not self._journalDir:
+            return
+        with self._cond:
+            self._temps.discard(temp)
+        try:
+            os.unlink(self._tempRecord(temp))
+        except FileNotFoundError:
+            pass
+    def partPath(self, transfer_id: str, file: str) -> str:
+        'The data of a journaled transfer, beside its destination so that finishing it is a rename.'
+        directory = os.path.dirname(file)
+        if not os.path.isdir(directory) or not os.access(directory, os.W_OK):
+            return self.journalPath(transfer_id, '.part')
+        return os.path.join(directory, '.%s.part' % transfer_id)
+    def _resumable(self, transfer_id: str, host: str, file: str, total: int, check: str) -> bool:
+        if not self._journalDir or transfer_id in self._journaled or not transfer_id.isalnum():
+            return False
+        try:
+            meta = json.load(open(self.journalPath(transfer_id, '.json')))
+        except (OSError, ValueError):
+            return False
+        return meta == {'host': host, 'file': file, 'total': total, 'check': check}
+    def discard(self, transfer_id: Optional[str]) -> None:
+        if transfer_id is None:
+            return
+        paths = [self.journalPath(transfer_id, ext) for ext in ('.json', '.log', '.part')]
+        try:
+            with open(paths[0]) as f:
+                paths.append(self.partPath(transfer_id, json.load(f)['file']))
+        except (OSError, ValueError, KeyError):
+            pass
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+    def purge(self, max_age: float) -> None:
+        '''
+        Removes journaled transfers that were not resumed for max_age
+        seconds, and the temp files of uploads that were neither finished
+        nor aborted, which only a crash leaves behind.
+        '''
+        if not self._journalDir:
+            return
+        deadline = time.time() - max_age
+        for entry in os.scandir(self._journalDir):
+            name, ext = os.path.splitext(entry.name)
+            if ext == '.json' and entry.stat().st_mtime < deadline and name not in self._journaled:
+                self.discard(name)
+            elif ext == '.temp':
+                try:
+                    with open(entry.path, encoding='utf-8') as f:
+                        temp = f.read()
+                except OSError:
+                    continue
+                with self._cond:
+                    if temp in self._temps:
+                        continue # still being received
+                try:
+                    os.unlink(temp)
+                except FileNotFoundError:
+                    pass
+                self.forget(temp)
+    def _admissible(self, ticket: list) -> bool:
+        if sum(self._active.values()) >= self._maxTransfers:
+            return False
+        for waiting in self._queue:
+            available = self._active[waiting[0]] < self._perHost
+            if waiting is ticket:
+                return available
+            if available:
+                return False # an earlier request goes first
+        return False
+    def _dequeue(self, ticket: list) -> bool:
+        # by identity: the tickets of one host are equal lists
+        for i, waiting in enumerate(self._queue):
+            if waiting is ticket:
+                del self._queue[i]
+                return True
+        return False
+    def _notify(self) -> None:
+        # with _cond held, whenever a slot or the queue changed
+        self._cond.notify_all()
+        for listener in self._listeners:
+            listener()
+    def _admit(self, host: str) -> bool:
+        if getattr(self._granted, 'host', None) == host:
+            self._granted.host = None
+            return True
+        ticket = [host]
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                if not self._cond.wait_for(lambda: self._admissible(ticket), self._queueTimeout):
+                    return False
+                self._active[host] += 1
+                return True
+            finally:
+                self._dequeue(ticket)
+                self._notify()
+    def listen(self, listener: Callable[[], None]) -> None:
+        'Calls listener, with the manager locked, every time a queued transfer may have become admissible.'
+        self._listeners.append(listener)
+    def enqueue(self, host: str) -> list:
+        '''
+        Queues a transfer of host for callers that wait without blocking a
+        thread: they claim the ticket whenever a listener fires, and
+        withdraw it once admitted or given up.
+        '''
+        ticket = [host]
+        with self._cond:
+            self._queue.append(ticket)
+        return ticket
+    def claim(self, ticket: list) -> bool:
+        with self._cond:
+            if not self._admissible(ticket):
+                return False
+            self._active[ticket[0]] += 1
+            self._dequeue(ticket)
+            self._notify()
+            return True
+    def withdraw(self, ticket: list) -> None:
+        with self._cond:
+            if self._dequeue(ticket):
+                self._notify()
+    def granted(self, host: str, func: Callable[[], None]) -> None:
+        'Runs func holding a slot claimed for host, which its next transfer takes instead of queueing; an unused slot is released.'
+        self._granted.host = host
+        try:
+            func()
+        finally:
+            if self._granted.host is not None:
+                self._granted.host = None
+                self._releaseHost(host)
+    def queueTimeout(self) -> Optional[float]:
+        return self._queueTimeout
+    def batch(self, host: str, manifest: bytes, files: List[Tuple[str, int]], dirs: List[str]) -> Optional['BatchTransmitter']:
+        print('New batch transmission from %s: %i files' % (host, len(files)))
+        if not self._admit(host):
+            return None
+        try:
+            return BatchTransmitter(self, host, manifest, files, dirs)
+        except Exception:
+            self._releaseHost(host)
+            raise
+    def stored(self, host: str, file: str, store: ChunkStore, keys: List[bytes]) -> Optional[StoreTransmitter]:
+        print('New deduplicated transmission from %s: %s' % (host, file))
+        if not self._admit(host):
+            return None
+        try:
+            return StoreTransmitter(self, host, file, store, keys)
+        except Exception:
+            self._releaseHost(host)
+            raise
+    def ranged(self, host: str, file: str, size: int, ranges: List[List[int]]) -> Optional[RangeTransmitter]:
+        print('New parallel transmission from %s: %s in %i ranges' % (host, file, len(ranges)))
+        if not self._admit(host):
+            return None
+        try:
+            t = RangeTransmitter(self, host, file, size, ranges)
+        except Exception:
+            self._releaseHost(host)
+            raise
+        with self._cond:
+            self._ranged[t.id()] = t
+        return t
+    def range(self, transfer_id: str, host: str, index: int) -> Optional[ByteRange]:
+        'Claims one range of a parallel transfer for the calling connection.'
+        with self._cond:
+            t = self._ranged.get(transfer_id)
+            if t is None or t.host() != host or not 0 <= index < t.count():
+                return None
+            r = t.range(index)
+            if r.claimed:
+                return None
+            r.claimed = True
+            return r
+    def transmission(self, host: str, file: str, total: int=0, journal: bool=False, resume: Optional[str]=None, check: str=checksum.DEFAULT, size: Optional[int]=None) -> Optional[Transmitter]:
+        print('New transmission from %s: %s' % (host, file))
+        if not self._admit(host):
+            return None
+        transfer_id = None
+        try:
+            with self._cond:
+                if resume and self._resumable(resume, host, file, total, check):
+                    transfer_id = resume
+                    print('Resuming transmission', transfer_id)
+                elif journal and self._journalDir:
+                    transfer_id = uuid.uuid4().hex
+                    with open(self.journalPath(transfer_id, '.json'), 'w') as f:
+                        json.dump({'host': host, 'file': file, 'total': total, 'check': check}, f)
+                if transfer_id:
+                    self._journaled.add(transfer_id)
+            return Transmitter(self, host, file, transfer_id, check, size)
+        except Exception:
+            with self._cond:
+                self._journaled.discard(transfer_id)
+            self._releaseHost(host)
+            raise
+    def _releaseHost(self, host: str) -> None:
+        with self._cond:
+            self._active[host] -= 1
+            if not self._active[host]:
+                del self._active[host]
+            self._notify()
+    def release(self, transmitter: Union[Transmitter, BatchTransmitter, RangeTransmitter, StoreTransmitter]) -> None:
+        with self._cond:
+            self._journaled.discard(transmitter.id())
+            self._ranged.pop(transmitter.id(), None)
+        self._releaseHost(transmitter.host())
+    def activeTransfers(self) -> int:
+        with self._cond:
+            return sum(self._active.values())
+    def queuedTransfers(self) -> int:
+        with self._cond:
+            return len(self._queue)
+    def trusted(self) -> Union[HostKeyMap, TrustStore]:
         return self._map
\ No newline at end of file